@@ -0,0 +1,103 @@
+import random
+import struct
+
+from construct_typed import DataclassStruct
+import pytest
+
+from timeguard_mqtt import codec, protocol
+
+SAMPLES_PER_TYPE = 200
+FLIPPED_PER_TYPE = 50
+
+
+def frame(rnd: random.Random, message_type_id: int, params: bytes) -> bytes:
+    payload = (
+        struct.pack(
+            "<BBHB3sI",
+            message_type_id & 0xF,
+            message_type_id >> 4,
+            len(params),
+            rnd.randrange(256),
+            rnd.randbytes(3),
+            rnd.getrandbits(32),
+        )
+        + params
+    )
+    return (
+        struct.pack("<2sHI", b"\xfa\xd4", len(payload), rnd.getrandbits(32))
+        + payload
+        + struct.pack("<H", protocol.crc16_xmodem(payload))
+        + b"\x2d\xdf"
+    )
+
+
+def random_params(rnd: random.Random, size: int, i: int) -> bytes:
+    params = bytearray(rnd.randbytes(size))
+    if i % 2 and size >= 50:
+        # Schedule names are 50 bytes of utf-8 at the end of the params
+        params[-50:] = "Расписание {}".format(i).encode()[:50].ljust(50, b"\0")
+    if i % 3 == 0:
+        # Keeps the flags and the enums within their ranges
+        params = bytearray(b % 2 for b in params)
+    return bytes(params)
+
+
+def outcome(func, *args):
+    try:
+        return "ok", func(*args)
+    except Exception as e:
+        return "error", type(e)
+
+
+def assert_same_parse(data: bytes) -> tuple:
+    expected = outcome(protocol.format.parse, data)
+    actual = outcome(codec.parse, data)
+
+    if expected[0] == "error" and actual[0] == "ok":
+        # The params are only decoded when they're accessed, that's when the error surfaces
+        with pytest.raises(expected[1]):
+            actual[1].payload.params
+        return expected
+
+    assert actual[0] == expected[0]
+    assert actual[1] == expected[1]
+    if expected[0] == "ok":
+        assert str(actual[1]) == str(expected[1])
+        assert repr(actual[1]) == repr(expected[1])
+
+    return expected
+
+
+def assert_same_build(data: bytes, parsed: protocol.Timeguard):
+    expected = outcome(protocol.format.build, parsed)
+    assert outcome(codec.build, parsed) == expected
+    assert outcome(codec.build, codec.parse(data)) == expected
+
+
+@pytest.mark.parametrize("message_type_id", sorted(protocol.Payload.MESSAGE_TYPE_MAP))
+def test_random_frames(message_type_id: int):
+    rnd = random.Random(message_type_id)
+    size = DataclassStruct(protocol.Payload.MESSAGE_TYPE_MAP[message_type_id]).sizeof()
+
+    for i in range(SAMPLES_PER_TYPE):
+        data = frame(rnd, message_type_id, random_params(rnd, size, i))
+        result, parsed = assert_same_parse(data)
+        if result == "ok":
+            assert_same_build(data, parsed)
+
+
+@pytest.mark.parametrize("message_type_id", sorted(protocol.Payload.MESSAGE_TYPE_MAP))
+def test_bit_flipped_frames(message_type_id: int):
+    rnd = random.Random(-message_type_id)
+    size = DataclassStruct(protocol.Payload.MESSAGE_TYPE_MAP[message_type_id]).sizeof()
+
+    for i in range(FLIPPED_PER_TYPE):
+        data = bytearray(frame(rnd, message_type_id, random_params(rnd, size, i)))
+        data[rnd.randrange(len(data))] ^= 1 << rnd.randrange(8)
+        assert_same_parse(bytes(data))
+
+
+def test_checksum_verified():
+    rnd = random.Random(0)
+    data = frame(rnd, 96, rnd.randbytes(16))
+    assert codec.parse(data, checksum_verified=True) == protocol.format.parse(data)
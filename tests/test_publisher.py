@@ -0,0 +1,113 @@
+from timeguard_mqtt.publisher import PublishCoalescer
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make(window: float = 0, rate_limit: float = 0):
+    clock = Clock()
+    published = []
+    coalescer = PublishCoalescer(
+        lambda topic, payload, qos, retain: published.append((topic, payload, qos)),
+        window,
+        rate_limit,
+        clock,
+    )
+    return coalescer, clock, published
+
+
+def test_passthrough():
+    coalescer, _, published = make()
+    coalescer.put("a", 1)
+    coalescer.put("a", 2)
+    assert published == [("a", 1, 0), ("a", 2, 0)]
+    assert len(coalescer) == 0
+
+
+def test_window_keeps_the_order_topics_were_first_touched():
+    coalescer, clock, published = make(window=1)
+    coalescer.put("a", 1)
+    clock.now = 0.5
+    coalescer.put("b", 1)
+    coalescer.put("a", 2, qos=1)
+
+    assert coalescer.flush() == 0
+    clock.now = 1
+    assert coalescer.flush() == 1
+    assert published == [("a", 2, 1)]
+    clock.now = 1.5
+    coalescer.flush()
+    assert published == [("a", 2, 1), ("b", 1, 0)]
+    assert coalescer.coalesced == 1
+
+
+def test_coalescing_keeps_the_highest_qos():
+    coalescer, clock, published = make(window=1)
+    coalescer.put("a", 1, qos=1)
+    coalescer.put("a", 2, qos=0)
+    clock.now = 1
+    coalescer.flush()
+    assert published == [("a", 2, 1)]
+
+
+def test_whole_number_rate():
+    coalescer, clock, published = make(rate_limit=2)
+    for topic in "abcde":
+        coalescer.put(topic)
+    assert [topic for topic, _, _ in published] == ["a", "b"]
+
+    clock.now = 1
+    coalescer.flush()
+    assert [topic for topic, _, _ in published] == ["a", "b", "c", "d"]
+
+    clock.now = 10
+    coalescer.flush()
+    assert len(published) == 5
+    assert len(coalescer) == 0
+
+
+def test_fractional_rate():
+    coalescer, clock, published = make(rate_limit=0.5)
+    coalescer.put("a")
+    coalescer.put("b")
+    assert len(published) == 1
+
+    clock.now = 1
+    coalescer.flush()
+    assert len(published) == 1
+
+    clock.now = 2
+    coalescer.flush()
+    assert len(published) == 2
+    assert len(coalescer) == 0
+
+
+def test_pause_and_resume():
+    coalescer, clock, published = make()
+    coalescer.pause()
+    coalescer.put("a", 1)
+    coalescer.put("a", 2)
+    coalescer.put("b", 1)
+    assert coalescer.flush() == 0
+    assert published == []
+    assert len(coalescer) == 2
+
+    coalescer.resume()
+    assert published == [("a", 2, 0), ("b", 1, 0)]
+
+    coalescer.put("c", 1)
+    assert published[-1] == ("c", 1, 0)
+
+
+def test_forced_flush_ignores_the_window_and_the_rate():
+    coalescer, _, published = make(window=10, rate_limit=1)
+    coalescer.pause()
+    for topic in "abc":
+        coalescer.put(topic)
+    assert coalescer.flush(force=True) == 3
+    assert len(published) == 3
@@ -0,0 +1,168 @@
+import asyncio
+from queue import Empty, Full
+import threading
+from time import monotonic
+
+import pytest
+
+from timeguard_mqtt import bench, codec, protocol
+from timeguard_mqtt.queues import CommandsQueue, NetworkEventsQueue, telemetry_key
+
+
+def ping_key(item):
+    # ("ping", device) items are telemetry, anything else is kept as is
+    return item[1] if item[0] == "ping" else None
+
+
+def drain(queue) -> list:
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def test_telemetry_key():
+    frames = dict(bench.sample_frames())
+    ping = codec.parse(codec.build(frames[96]))
+    assert telemetry_key(ping) == (ping.payload.device_id, False)
+
+    other = codec.parse(codec.build(frames[98]))
+    assert other.payload.message_type != protocol.MessageType.PING
+    assert telemetry_key(other) is None
+
+
+def test_pings_are_coalesced_per_device():
+    queue = NetworkEventsQueue(key=ping_key)
+    queue.put(("ping", 1, "a"))
+    queue.put(("cmd", 1, "b"))
+    queue.put(("ping", 2, "c"))
+    queue.put(("ping", 1, "d"))
+
+    assert queue.qsize() == 3
+    assert queue.coalesced == 1
+    assert drain(queue) == [("ping", 1, "d"), ("cmd", 1, "b"), ("ping", 2, "c")]
+
+    # Once taken, the device's next ping gets a slot of its own
+    queue.put(("ping", 1, "e"))
+    assert drain(queue) == [("ping", 1, "e")]
+
+
+def test_overflow_drops_the_oldest_ping_then_the_new_item():
+    queue = NetworkEventsQueue(3, key=ping_key)
+    queue.put(("ping", 1, "a"))
+    queue.put(("cmd", 1, "b"))
+    queue.put(("ping", 2, "c"))
+
+    queue.put(("cmd", 2, "d"))
+    assert queue.overflows == 1
+    assert queue.qsize() == 3
+
+    queue.put(("ping", 3, "e"))
+    assert queue.overflows == 2
+    assert queue.qsize() == 3
+
+    # No pings left to make room with
+    queue.put_nowait(("cmd", 3, "f"))
+    queue.put_nowait(("cmd", 4, "g"))
+    assert queue.overflows == 4
+    assert queue.high_water == 3
+    assert drain(queue) == [("cmd", 1, "b"), ("cmd", 2, "d"), ("cmd", 3, "f")]
+
+
+def test_dropped_slots_are_compacted():
+    queue = NetworkEventsQueue(2, key=ping_key)
+    for device in range(100):
+        queue.put(("ping", device, None))
+
+    assert queue.qsize() == 2
+    assert len(queue._items) <= 2 * queue.maxsize + 1
+    assert drain(queue) == [("ping", 98, None), ("ping", 99, None)]
+
+
+def test_get_timeout():
+    queue = NetworkEventsQueue(key=ping_key)
+    with pytest.raises(Empty):
+        queue.get_nowait()
+
+    started = monotonic()
+    with pytest.raises(Empty):
+        queue.get(timeout=0.05)
+    assert monotonic() - started >= 0.05
+
+    threading.Timer(0.05, queue.put, (("cmd", 1, "a"),)).start()
+    assert queue.get(timeout=5) == ("cmd", 1, "a")
+
+
+def test_commands_queue_bounds_only_what_isnt_waited_for():
+    queue = CommandsQueue(2)
+    queue.put_nowait("query 1")
+    queue.put_nowait("query 2")
+    with pytest.raises(Full):
+        queue.put_nowait("query 3")
+
+    # The commands are accepted anyway, and don't wait for the room
+    queue.put("command")
+    assert queue.qsize() == 3
+    assert queue.overflows == 2
+    assert queue.high_water == 3
+    assert drain(queue) == ["query 1", "query 2", "command"]
+
+
+def test_commands_queue_bridge():
+    queue = CommandsQueue(2)
+    queue.put("waiting")
+
+    async def main():
+        events = queue.bridge(asyncio.get_running_loop())
+        assert await events.get() == "waiting"
+
+        producer = threading.Thread(target=queue.put, args=("from thread",))
+        producer.start()
+        producer.join()
+        assert await asyncio.wait_for(events.get(), 5) == "from thread"
+
+        # Both still take up room until they're reported taken
+        assert queue.qsize() == 2
+        with pytest.raises(Full):
+            queue.put_nowait("query")
+
+        queue.taken()
+        queue.taken()
+        assert queue.qsize() == 0
+        queue.put_nowait("query")
+
+        # Handed over, but never taken by the loop; one more is not even handed over yet
+        await asyncio.sleep(0)
+        queue.put("command")
+        queue.unbridge()
+
+    asyncio.run(main())
+
+    assert queue.qsize() == 2
+    assert drain(queue) == ["query", "command"]
+
+
+def test_commands_queue_taken_releases_a_waiting_put():
+    queue = CommandsQueue(1)
+    released = threading.Event()
+
+    async def main():
+        events = queue.bridge(asyncio.get_running_loop())
+        queue.put("command")
+        await events.get()
+
+        def wait_for_room():
+            with queue.not_full:
+                while queue._qsize() >= queue.maxsize:
+                    if not queue.not_full.wait(5):
+                        return
+            released.set()
+
+        waiter = threading.Thread(target=wait_for_room)
+        waiter.start()
+        queue.taken()
+        waiter.join(5)
+        queue.unbridge()
+
+    asyncio.run(main())
+    assert released.is_set()
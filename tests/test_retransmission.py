@@ -0,0 +1,198 @@
+from timeguard_mqtt import protocol
+from timeguard_mqtt.bench import make_args
+from timeguard_mqtt.protocol_handler import ProtocolHandler
+from timeguard_mqtt.retransmission import RetransmissionScheduler, SequenceAllocator
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make(**kwargs):
+    clock = Clock()
+    removed = []
+    scheduler = RetransmissionScheduler(
+        resend_interval=2,
+        give_up_after=5,
+        clock=clock,
+        on_remove=removed.append,
+        **kwargs,
+    )
+    return scheduler, clock, removed
+
+
+def keys(pending_commands) -> list:
+    return [pending.key for pending in pending_commands]
+
+
+def test_resend_at_the_interval():
+    scheduler, clock, _ = make()
+    scheduler.add("a", "data a")
+    clock.now = 1
+    scheduler.add("b", "data b")
+
+    assert scheduler.next_deadline() == 2
+    assert scheduler.pop_due(1.9) == []
+    assert keys(scheduler.pop_due(2)) == ["a"]
+    assert scheduler.next_deadline() == 3
+    assert keys(scheduler.pop_due(3)) == ["b"]
+    assert keys(scheduler.pop_due(4)) == ["a"]
+    assert scheduler.get("a").data == "data a"
+    assert scheduler.resends == 3
+
+
+def test_late_pop_resends_once():
+    scheduler, _, _ = make()
+    scheduler.add("a", None)
+    assert keys(scheduler.pop_due(3.5)) == ["a"]
+    assert scheduler.next_deadline() == 5.5
+
+
+def test_expiry_at_give_up_after():
+    scheduler, clock, removed = make()
+    scheduler.add("a", None)
+
+    assert keys(scheduler.pop_due(2)) == ["a"]
+    assert keys(scheduler.pop_due(4)) == ["a"]
+    assert scheduler.pop_due(6) == []
+    assert "a" not in scheduler
+    assert len(scheduler) == 0
+    assert scheduler.next_deadline() is None
+    assert removed == ["a"]
+    assert scheduler.expiries == 1
+
+
+def test_acknowledged_commands_leave_stale_heap_entries_behind():
+    scheduler, clock, removed = make()
+    scheduler.add("a", None)
+    clock.now = 1
+    scheduler.add("b", None)
+
+    assert scheduler.acknowledge("a")
+    assert not scheduler.acknowledge("a")
+    assert removed == ["a"]
+    assert scheduler.next_deadline() == 3
+    assert keys(scheduler.pop_due(3)) == ["b"]
+
+
+def test_readded_key_replaces_the_old_command():
+    scheduler, clock, _ = make()
+    scheduler.add("a", "old")
+    clock.now = 1
+    scheduler.add("a", "new")
+
+    assert scheduler.next_deadline() == 3
+    resent = scheduler.pop_due(3)
+    assert [pending.data for pending in resent] == ["new"]
+
+
+def test_counters():
+    scheduler, clock, _ = make()
+    for key in "abc":
+        scheduler.add(key, None)
+
+    scheduler.acknowledge("a")
+    scheduler.pop_due(2)
+    clock.now = 2
+    scheduler.acknowledge("b")
+    scheduler.pop_due(10)
+
+    assert scheduler.stats() == {
+        "pending": 0,
+        "resends": 2,
+        "expiries": 1,
+        "acknowledgements": 2,
+    }
+
+
+def test_sequences_run_out_per_device():
+    sequences = SequenceAllocator(3)
+    assert [sequences.allocate(1) for _ in range(4)] == [0, 1, 2, None]
+    assert sequences.inflight(1) == 3
+    # Another device has numbers of its own
+    assert sequences.allocate(2) == 0
+    assert sequences.inflight(2) == 1
+
+
+def test_released_sequences_go_to_the_end_of_the_line():
+    sequences = SequenceAllocator(3)
+    for _ in range(3):
+        sequences.allocate(1)
+
+    sequences.release(1, 1)
+    assert sequences.inflight(1) == 2
+    assert sequences.allocate(1) == 3
+
+    sequences.release(1, 5)
+    assert sequences.allocate(1) == 4
+
+
+def test_device_is_forgotten_once_nothing_is_in_flight():
+    sequences = SequenceAllocator()
+    sequences.release(1, 0)
+    seq = sequences.allocate(1)
+    sequences.release(1, seq)
+    assert sequences.inflight(1) == 0
+    assert 1 not in sequences._free
+
+
+def test_max_inflight_is_capped_by_the_sequence_space():
+    sequences = SequenceAllocator(1000)
+    assert sequences.max_inflight_per_device == SequenceAllocator.SEQ_COUNT
+    assert (
+        len({sequences.allocate(1) for _ in range(SequenceAllocator.SEQ_COUNT)}) == 255
+    )
+    assert sequences.allocate(1) is None
+
+
+def test_sequences_are_released_on_ack_and_on_expiry():
+    sequences = SequenceAllocator(2)
+    scheduler, clock, _ = make()
+    scheduler.on_remove = lambda key: sequences.release(*key)
+
+    for device_id in (1, 2):
+        for _ in range(2):
+            scheduler.add((device_id, sequences.allocate(device_id)), None)
+
+    assert sequences.allocate(1) is None
+    assert len(scheduler) == 4
+
+    # The same sequence number of another device is a different command
+    scheduler.acknowledge((1, 0))
+    assert (2, 0) in scheduler
+    assert sequences.inflight(1) == 1
+    scheduler.add((1, sequences.allocate(1)), None)
+    assert (1, 2) in scheduler
+
+    scheduler.pop_due(5)
+    assert len(scheduler) == 0
+    assert sequences.inflight(1) == 0
+    assert sequences.inflight(2) == 0
+
+
+def test_handler_numbers_the_commands_per_device():
+    handler = ProtocolHandler(make_args("--max-inflight-per-device", "2"), None, None)
+
+    def command(device_id: int) -> protocol.Timeguard:
+        return protocol.Timeguard.prepare(
+            protocol.MessageType.WORK_MODE,
+            protocol.MessageFlags.server(True),
+            device_id,
+            work_mode=protocol.WorkMode.AUTO,
+        )
+
+    first = [
+        handler.add_command_to_waiting_list(command(device_id)) for device_id in (1, 2)
+    ]
+    assert [data.payload.seq for data in first] == [0, 0]
+
+    assert handler.add_command_to_waiting_list(command(1)).payload.seq == 1
+    assert handler.add_command_to_waiting_list(command(1)) is None
+
+    assert handler._waiting_for_response.acknowledge((1, 0))
+    assert (2, 0) in handler._waiting_for_response
+    assert handler.add_command_to_waiting_list(command(1)).payload.seq == 2
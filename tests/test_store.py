@@ -0,0 +1,41 @@
+from timeguard_mqtt.store import DeviceStore
+
+
+def test_pending_writes_are_read_without_a_flush(tmp_path):
+    store = DeviceStore(str(tmp_path / "state.db"), flush_interval=3600)
+    store.save_parameter(1, "code_version", "x1")
+    store.save_schedule(1, 0, b"schedule")
+    store.save_address(1, ("10.0.0.1", 9997))
+
+    assert store.load(1) == ({"code_version": "x1"}, {0: b"schedule"})
+    assert store.get_address(1) == ("10.0.0.1", 9997)
+    assert store._db.execute("SELECT COUNT(*) FROM parameters").fetchone() == (0,)
+    store.close()
+
+
+def test_state_is_kept_between_restarts(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = DeviceStore(path)
+    store.save_parameter(1, "code_version", "x1")
+    store.save_address(1, ("10.0.0.1", 9997))
+    store.save_address(1, ("10.0.0.1", 9998))
+    store.close()
+
+    store = DeviceStore(path)
+    assert store.load(1) == ({"code_version": "x1"}, {})
+    assert store.load(2) == ({}, {})
+    assert store.get_address(1) == ("10.0.0.1", 9998)
+    assert store.get_address(2) is None
+    store.close()
+
+
+def test_addresses_are_served_from_memory(tmp_path):
+    store = DeviceStore(str(tmp_path / "state.db"))
+    store.save_address(1, ("10.0.0.1", 9997))
+    store.flush()
+
+    # A flush in progress holds the database
+    with store._db_lock:
+        assert store.get_address(1) == ("10.0.0.1", 9997)
+        assert store.get_address(2) is None
+    store.close()
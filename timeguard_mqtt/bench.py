@@ -0,0 +1,503 @@
+import argparse
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import platform
+import select
+import socket
+import sys
+from time import perf_counter
+from timeit import Timer
+import tracemalloc
+import typing
+
+from arrow import Arrow
+
+from timeguard_mqtt import codec, crc, protocol
+from timeguard_mqtt.mqtt import Mqtt
+from timeguard_mqtt.protocol_handler import ProtocolHandler
+from timeguard_mqtt.receiver import BatchReceiver
+
+DEVICE_ID = 0x12345678
+
+
+def _schedule_info_params() -> dict:
+    ret = {"schedule_id": 1, "name": "Weekdays"}
+    for i in range(1, protocol.MAX_SCHEDULES_COUNT + 1):
+        ret["schedule{}".format(i)] = protocol.Schedule(
+            start=protocol.ScheduleTime(
+                reserved=0, is_enabled=True, minutes_from_midnight=6 * 60
+            ),
+            end=protocol.ScheduleTime(
+                reserved=0, is_enabled=True, minutes_from_midnight=8 * 60
+            ),
+            repeat=protocol.ScheduleRepeats.MONDAY | protocol.ScheduleRepeats.FRIDAY,
+            unknown=b"\x00",
+        )
+    return ret
+
+
+def _ping_request_params() -> dict:
+    return {
+        "state": protocol.DeviceState(
+            switch_state=protocol.SwitchState.ON,
+            unknown1=0,
+            load_detected=True,
+            advance_mode_state=protocol.AdvanceState.OFF,
+            load_was_detected_previously=True,
+            unknown2=0,
+        ),
+        "unknown2": b"\x00\x00\x00",
+        "work_mode": protocol.WorkMode.AUTO,
+        "unknown3": b"\x00\x00\x00",
+        "uptime": 86400,
+        "boost": protocol.Boost(
+            boost_type=protocol.BoostState.ONE_HOUR, minutes_from_sunday=1500
+        ),
+        "unknown4": 0,
+    }
+
+
+def _holiday_params() -> dict:
+    return {
+        "is_active": True,
+        "unknown": b"\x00\x00\x00",
+        "start": Arrow(2023, 7, 1),
+        "end": Arrow(2023, 7, 14),
+    }
+
+
+SAMPLE_PARAMS: typing.Dict[type, typing.Callable[[], dict]] = {
+    protocol.PingRequest: _ping_request_params,
+    protocol.PingResponse: lambda: {"now": Arrow(2023, 3, 1, 12, 30)},
+    protocol.CodeVersion: lambda: {"code_version": "4191700000101"},
+    protocol.BoostRequest: lambda: {"boost_type": protocol.BoostState.TWO_HOURS},
+    protocol.BoostResponse: lambda: {
+        "expected_finish_time": protocol.Boost(
+            boost_type=protocol.BoostState.TWO_HOURS, minutes_from_sunday=1620
+        ),
+        "boost_start_config": protocol.Boost(
+            boost_type=protocol.BoostState.TWO_HOURS, minutes_from_sunday=1500
+        ),
+    },
+    protocol.AdvanceModeRequest: lambda: {"mode": protocol.AdvanceState.ON},
+    protocol.SetWorkmodeRequest: lambda: {"work_mode": protocol.WorkMode.ALWAYS_ON},
+    protocol.SetHolidayRequest: _holiday_params,
+    protocol.GetCurrentScheduleResponse: lambda: {"schedule_id": 2},
+    protocol.SetScheduleNameRequest: lambda: {"schedule_id": 2, "name": "Weekends"},
+    protocol.GetScheduleInfoResponse: _schedule_info_params,
+    protocol.Empty: lambda: {},
+}
+
+
+def sample_params(params_class: type) -> dict:
+    for cls in params_class.__mro__:
+        if cls in SAMPLE_PARAMS:
+            return SAMPLE_PARAMS[cls]()
+
+    raise Exception("No sample params for {}".format(params_class.__name__))
+
+
+def sample_frames() -> typing.Iterator[typing.Tuple[int, protocol.Timeguard]]:
+    for message_type_id, params_class in protocol.Payload.MESSAGE_TYPE_MAP.items():
+        yield message_type_id, protocol.Timeguard.prepare(
+            protocol.MessageType(message_type_id & 0b1111),
+            protocol.MessageFlags(message_type_id >> 4),
+            DEVICE_ID,
+            payload_seq=0x10,
+            **sample_params(params_class),
+        )
+
+
+class EventSink:
+    # Stands in for the inter-thread queues, so the benchmarks don't accumulate events
+
+    def put(self, item, block=True, timeout=None):
+        pass
+
+    def put_nowait(self, item):
+        pass
+
+
+class StubMqttClient:
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+
+def make_args(*argv: str) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", action="store_true")
+    ProtocolHandler.prepare_argparse(parser)
+    Mqtt.prepare_argparse(parser)
+    return parser.parse_args(argv)
+
+
+class Bench:
+    def __init__(self, repeat: int = 3):
+        self.repeat = repeat
+        self.results: typing.List[dict] = []
+
+    def measure(
+        self,
+        benchmark: str,
+        case: str,
+        func: typing.Callable[[], typing.Any],
+        implementation: typing.Optional[str] = None,
+    ) -> float:
+        timer = Timer(func)
+        number, _ = timer.autorange()
+        seconds = min(timer.repeat(repeat=self.repeat, number=number)) / number
+        self.add(
+            benchmark,
+            case,
+            implementation,
+            seconds_per_op=seconds,
+            ops_per_second=1 / seconds,
+        )
+
+        return seconds
+
+    def measure_memory(
+        self,
+        benchmark: str,
+        case: str,
+        func: typing.Callable[[], typing.Any],
+        implementation: typing.Optional[str] = None,
+        number: int = 100,
+    ) -> float:
+        # Peak of the memory allocated by a call, short-lived objects included, on top of what was there before it
+        func()
+        tracemalloc.start()
+        try:
+            peak = 0
+            for _ in range(number):
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                func()
+                peak += tracemalloc.get_traced_memory()[1] - current
+        finally:
+            tracemalloc.stop()
+
+        self.add(benchmark, case, implementation, peak_bytes_per_op=peak / number)
+
+        return peak / number
+
+    def add(
+        self,
+        benchmark: str,
+        case: str,
+        implementation: typing.Optional[str] = None,
+        **values,
+    ):
+        self.results.append(
+            {
+                "benchmark": benchmark,
+                "case": case,
+                "implementation": implementation,
+            }
+            | values
+        )
+
+
+def _case(message_type_id: int, frame: protocol.Timeguard) -> str:
+    return "{} ({})".format(type(frame.payload.params).__name__, message_type_id)
+
+
+def bench_parse(bench: Bench):
+    for message_type_id, frame in sample_frames():
+        data = codec.build(frame)
+        case = _case(message_type_id, frame)
+        bench.measure("parse", case, lambda: protocol.format.parse(data), "construct")
+        bench.measure("parse", case, lambda: codec.parse(data), "codec")
+        bench.measure(
+            "parse", case, lambda: codec.parse(data).payload.params, "codec+params"
+        )
+
+
+def bench_build(bench: Bench):
+    for message_type_id, frame in sample_frames():
+        case = _case(message_type_id, frame)
+        bench.measure("build", case, lambda: protocol.format.build(frame), "construct")
+        bench.measure("build", case, lambda: codec.build(frame), "codec")
+
+
+def bench_prepare(bench: Bench):
+    for message_type_id, frame in sample_frames():
+        message_type = frame.payload.message_type
+        message_flags = frame.payload.message_flags
+        params = sample_params(type(frame.payload.params))
+
+        def prepare():
+            return protocol.Timeguard.prepare(
+                message_type, message_flags, DEVICE_ID, payload_seq=0x10, **params
+            )
+
+        case = _case(message_type_id, frame)
+        bench.measure("prepare", case, prepare)
+        bench.measure(
+            "prepare+build",
+            case,
+            lambda: protocol.format.build(prepare()),
+            "construct",
+        )
+        bench.measure("prepare+build", case, lambda: codec.build(prepare()), "codec")
+
+
+def bench_relay_callback(bench: Bench):
+    frames = dict(sample_frames())
+    cases = {
+        "client ping": ("10.0.0.2", 9997, codec.build(frames[96])),
+        "client code version": ("10.0.0.2", 9997, codec.build(frames[98])),
+        "server ping": (ProtocolHandler.CLOUDWARM_IP, 9997, codec.build(frames[240])),
+        "server schedule": (
+            ProtocolHandler.CLOUDWARM_IP,
+            9997,
+            codec.build(frames[229]),
+        ),
+    }
+
+    for mode in ("relay", "fallback", "local"):
+        handler = ProtocolHandler(make_args("--mode", mode), EventSink(), EventSink())
+        handler.store_client(DEVICE_ID, "10.0.0.2", 9997)
+
+        for case, (source_ip, source_port, data) in cases.items():
+            bench.measure(
+                "relay_callback",
+                case,
+                lambda: handler.relay_callback(source_ip, source_port, data),
+                mode,
+            )
+
+
+def bench_mqtt(bench: Bench):
+    # The handler gets what the protocol handler has parsed, with all the computed fields in place
+    frames = {
+        message_type_id: codec.parse(codec.build(frame))
+        for message_type_id, frame in sample_frames()
+    }
+    cases = {
+        "ping": frames[96],
+        "code version": frames[98],
+        "schedule": frames[85],
+        "active schedule": frames[91],
+    }
+
+    for discovery in (False, True):
+        args = make_args(
+            "--mqtt-host",
+            "localhost",
+            *(("--homeassistant-discovery",) if discovery else ()),
+        )
+        mqtt = Mqtt(args, EventSink(), EventSink())
+        mqtt.client = StubMqttClient()
+        for frame in cases.values():
+            mqtt.handle_protocol_data(frame)
+
+        for case, frame in cases.items():
+            bench.measure(
+                "mqtt.handle_protocol_data",
+                case,
+                lambda: mqtt.handle_protocol_data(frame),
+                "discovery" if discovery else "plain",
+            )
+            bench.measure_memory(
+                "mqtt.handle_protocol_data",
+                case,
+                lambda: mqtt.handle_protocol_data(frame),
+                "discovery" if discovery else "plain",
+            )
+
+        # Publishing every parameter of a device, as done after announcing it
+        bench.measure_memory(
+            "mqtt.report_state",
+            "all parameters",
+            lambda: mqtt.report_state(DEVICE_ID, force=True),
+            "discovery" if discovery else "plain",
+        )
+
+
+def _reject(data: bytes):
+    try:
+        codec.parse(data)
+    except Exception:
+        pass
+
+
+def bench_crc(bench: Bench, batch_size: int = 1024):
+    frames = dict(sample_frames())
+    data = codec.build(frames[85])
+    payload = data[crc.frame_header.size : -crc.frame_trailer.size]
+    corrupted = bytearray(data)
+    corrupted[20] ^= 0xFF
+    corrupted = bytes(corrupted)
+
+    case = "{} bytes".format(len(payload))
+    if crc.HAS_EXTENSION:
+        bench.measure("crc16", case, lambda: crc.crc16_xmodem(payload), "crcmod")
+    bench.measure("crc16", case, lambda: crc.crc16_xmodem_table(payload), "table")
+
+    bench.measure("reject", "corrupted schedule", lambda: _reject(corrupted), "parse")
+    bench.measure(
+        "reject", "corrupted schedule", lambda: crc.verify_frame(corrupted), "verify"
+    )
+
+    # A capture-like mix of message types, every 10th frame is corrupted
+    batch = [codec.build(frame) for _, frame in frames.items()]
+    batch = [batch[i % len(batch)] for i in range(batch_size)]
+    batch[::10] = [frame[:-5] + b"\x00" + frame[-4:] for frame in batch[::10]]
+
+    case = "{} frames".format(batch_size)
+    bench.measure(
+        "verify_frames", case, lambda: crc.verify_frames(batch, False), "loop"
+    )
+    if crc.numpy is not None:
+        bench.measure(
+            "verify_frames", case, lambda: crc.verify_frames(batch, True), "numpy"
+        )
+
+
+def _blast(port: int, data: bytes, stop):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    while not stop.is_set():
+        for _ in range(256):
+            try:
+                sock.sendto(data, ("127.0.0.1", port))
+            except OSError:
+                # The receiver can't keep up
+                pass
+
+
+def bench_receive(
+    bench: Bench,
+    batch_sizes: typing.Iterable[int] = (1, 8, 32, 128),
+    duration: float = 1.0,
+):
+    frames = dict(sample_frames())
+    data = codec.build(frames[96])
+
+    for batch_size in batch_sizes:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.setblocking(False)
+        sock.bind(("127.0.0.1", 0))
+        receiver = BatchReceiver(batch_size)
+
+        stop = multiprocessing.Event()
+        blaster = multiprocessing.Process(
+            target=_blast, args=(sock.getsockname()[1], data, stop), daemon=True
+        )
+        blaster.start()
+
+        packets = 0
+        started_at = perf_counter()
+        while perf_counter() - started_at < duration:
+            select.select([sock], [], [], 0.1)
+            for datagram, _ in receiver.drain(sock):
+                codec.parse(datagram)
+                packets += 1
+        elapsed = perf_counter() - started_at
+
+        stop.set()
+        blaster.join()
+        sock.close()
+
+        bench.add(
+            "receive",
+            "batch_size={}".format(batch_size),
+            packets_per_second=packets / elapsed,
+        )
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "build": bench_build,
+    "prepare": bench_prepare,
+    "crc": bench_crc,
+    "relay_callback": bench_relay_callback,
+    "mqtt": bench_mqtt,
+    "receive": bench_receive,
+}
+
+
+def print_results(results: typing.List[dict], file=sys.stderr):
+    for result in results:
+        if "seconds_per_op" in result:
+            value = "{:>12.2f} us".format(result["seconds_per_op"] * 1e6)
+        elif "peak_bytes_per_op" in result:
+            value = "{:>12.0f} bytes".format(result["peak_bytes_per_op"])
+        else:
+            value = "{:>12.0f} packets/s".format(result["packets_per_second"])
+
+        print(
+            "{:<26} {:<36} {:<14} {}".format(
+                result["benchmark"],
+                result["case"],
+                result["implementation"] or "",
+                value,
+            ),
+            file=file,
+        )
+
+
+def run(argv: typing.Optional[typing.List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="timeguard-mqtt bench",
+        description="Micro-benchmarks for the codec and the processing pipeline",
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        choices=list(BENCHMARKS.keys()),
+        help="Run only the given benchmark, can be specified multiple times.",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="Write JSON results to the file instead of stdout.",
+    )
+    parser.add_argument(
+        "--repeat",
+        default=3,
+        type=int,
+        help="Number of measurements per case, the best one is reported.",
+    )
+    parser.add_argument(
+        "--quiet",
+        "-q",
+        help="Don't print the human-readable summary to stderr.",
+        action="store_true",
+    )
+    options = parser.parse_args(argv)
+
+    bench = Bench(options.repeat)
+    for name in options.only or BENCHMARKS.keys():
+        started = len(bench.results)
+        BENCHMARKS[name](bench)
+        if not options.quiet:
+            print_results(bench.results[started:])
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "results": bench.results,
+    }
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    run()
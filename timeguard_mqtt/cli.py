@@ -1,16 +1,31 @@
 import argparse
 import logging
-from queue import Queue
+import multiprocessing
 import signal
 import sys
 import threading
 
-from timeguard_mqtt import log
+from timeguard_mqtt import bench as benchmarks, log, metrics, queues, simulator, store
 from timeguard_mqtt.mqtt import Mqtt
 from timeguard_mqtt.protocol_handler import ProtocolHandler
+from timeguard_mqtt.workers import WorkerPool
+
+
+def bench():
+    benchmarks.run(sys.argv[2:])
+
+
+def simulate():
+    simulator.run(sys.argv[2:])
 
 
 def run():
+    if sys.argv[1:2] == ["bench"]:
+        return bench()
+
+    if sys.argv[1:2] == ["simulate"]:
+        return simulate()
+
     lh = logging.StreamHandler(sys.stdout)
     log.addHandler(lh)
     log.setLevel(logging.INFO)
@@ -28,6 +43,18 @@ def run():
     ProtocolHandler.prepare_argparse(protocol_params_parser)
     mqtt_params_parser = parser.add_argument_group("MQTT", "MQTT-related parameters")
     Mqtt.prepare_argparse(mqtt_params_parser)
+    metrics_params_parser = parser.add_argument_group(
+        "Metrics", "Prometheus exporter parameters"
+    )
+    metrics.prepare_argparse(metrics_params_parser)
+    state_params_parser = parser.add_argument_group(
+        "State", "Keeping the devices' state between the restarts"
+    )
+    store.prepare_argparse(state_params_parser)
+    queues_params_parser = parser.add_argument_group(
+        "Queues", "Limits of the queues between the UDP and MQTT sides"
+    )
+    queues.prepare_argparse(queues_params_parser)
     args = parser.parse_args()
 
     if args.debug:
@@ -38,11 +65,33 @@ def run():
 
     lh.setFormatter(logging.Formatter(log_format, datefmt="%d/%m/%Y %H:%M:%S"))
 
-    network_events_queue = Queue(maxsize=0)
-    mqtt_events_queue = Queue(maxsize=0)
+    mqtt_events_queue = queues.CommandsQueue(maxsize=args.commands_queue_size)
 
-    p = ProtocolHandler(args, network_events_queue, mqtt_events_queue)
-    mqtt = Mqtt(args, network_events_queue, mqtt_events_queue)
+    device_store = None
+    if args.state_file:
+        device_store = store.DeviceStore(args.state_file, args.state_flush_interval)
+
+    if args.workers > 1:
+        # The addresses are owned by the workers, only the MQTT side of the state is kept
+        network_events_queue = multiprocessing.Queue(maxsize=args.network_queue_size)
+        p = WorkerPool(args, network_events_queue, mqtt_events_queue)
+        p.start_workers()
+    else:
+        network_events_queue = queues.NetworkEventsQueue(args.network_queue_size)
+        p = ProtocolHandler(
+            args, network_events_queue, mqtt_events_queue, device_store=device_store
+        )
+        p.watch_metrics()
+    mqtt = Mqtt(args, network_events_queue, mqtt_events_queue, device_store)
+
+    if device_store is not None:
+        device_store.start()
+
+    if args.metrics_port:
+        metrics.watch_queues(
+            network_events=network_events_queue, mqtt_events=mqtt_events_queue
+        )
+        metrics.MetricsServer(args.metrics_address, args.metrics_port).start()
 
     protocol_thread = threading.Thread(target=p.run)
     mqtt_thread = threading.Thread(target=mqtt.run)
@@ -63,6 +112,9 @@ def run():
     except KeyboardInterrupt:
         termination()
 
+    if device_store is not None:
+        device_store.close()
+
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,662 @@
+import dataclasses
+import struct
+import typing
+
+from arrow import Arrow
+from construct import ConstructError
+from construct.lib import HexDisplayedBytes, HexDisplayedInteger, HexDumpDisplayedBytes
+
+from timeguard_mqtt import protocol
+from timeguard_mqtt.crc import FRAME_FOOTER, FRAME_HEADER, frame_header, frame_trailer
+
+# A hand-written codec for the message types seen on every ping/command round-trip. It produces exactly the same
+# dataclasses as `protocol.format`, and falls back to it for everything else (unknown message types, malformed frames
+# and values `construct` would refuse to build), so the construct definition stays the single source of truth.
+
+payload_header = struct.Struct("<BBHB3sI")
+
+EPOCH = Arrow(1970, 1, 1)
+
+
+def _bits(value: int, width: int) -> int:
+    if not isinstance(value, int) or not 0 <= value < 1 << width:
+        raise ValueError("value {} doesn't fit into {} bits".format(value, width))
+    return value
+
+
+def _enum(value, enum_type) -> int:
+    if not isinstance(value, enum_type):
+        raise TypeError("{!r} has to be of type {!r}".format(value, enum_type))
+    return int(value)
+
+
+def _raw_bytes(value, length: int) -> bytes:
+    if isinstance(value, int):
+        return value.to_bytes(length, "big")
+    if len(value) != length:
+        raise ValueError("expected {} bytes, got {}".format(length, len(value)))
+    return bytes(value)
+
+
+def _padded_string(value: str, length: int, encoding: str) -> bytes:
+    if not isinstance(value, str):
+        raise TypeError("{!r} is not a string".format(value))
+    data = value.encode(encoding)
+    if len(data) > length:
+        raise ValueError("string is longer than {} bytes".format(length))
+    return data.ljust(length, b"\x00")
+
+
+def _decode_padded_string(data: bytes, encoding: str) -> str:
+    return bytes(data).rstrip(b"\x00").decode(encoding)
+
+
+def _decode_boost(value: int) -> protocol.Boost:
+    boost = protocol.Boost(
+        boost_type=protocol.BoostState(value >> 14),
+        minutes_from_sunday=value & 0x3FFF,
+    )
+    boost.duration_in_minutes = (
+        60 if boost.boost_type == 1 else 120 if boost.boost_type == 2 else 0
+    )
+    boost.expected_finish_time = boost.minutes_from_sunday + boost.duration_in_minutes
+    return boost
+
+
+def _encode_boost(boost: protocol.Boost) -> int:
+    return _bits(_enum(boost.boost_type, protocol.BoostState), 2) << 14 | _bits(
+        boost.minutes_from_sunday, 14
+    )
+
+
+def _decode_schedule_time(value: int) -> protocol.ScheduleTime:
+    return protocol.ScheduleTime(
+        reserved=value >> 13,
+        is_enabled=bool(value & 0x1000),
+        minutes_from_midnight=value & 0x0FFF,
+    )
+
+
+def _encode_schedule_time(schedule_time: protocol.ScheduleTime) -> int:
+    return (
+        _bits(schedule_time.reserved, 3) << 13
+        | bool(schedule_time.is_enabled) << 12
+        | _bits(schedule_time.minutes_from_midnight, 12)
+    )
+
+
+def _decode_empty(cls, data: bytes, offset: int):
+    return cls()
+
+
+def _encode_empty(params) -> bytes:
+    return b""
+
+
+ping_request = struct.Struct("<B3sB3sIHH")
+
+
+def _decode_ping_request(cls, data: bytes, offset: int) -> protocol.PingRequest:
+    (
+        state,
+        unknown2,
+        work_mode,
+        unknown3,
+        uptime,
+        boost,
+        unknown4,
+    ) = ping_request.unpack_from(data, offset)
+
+    return cls(
+        state=protocol.DeviceState(
+            switch_state=protocol.SwitchState(state & 0b11),
+            unknown1=state >> 2 & 1,
+            load_detected=bool(state & 0b1000),
+            advance_mode_state=protocol.AdvanceState(state >> 4 & 1),
+            load_was_detected_previously=bool(state & 0b100000),
+            unknown2=state >> 6,
+        ),
+        unknown2=HexDisplayedBytes(unknown2),
+        work_mode=protocol.WorkMode(work_mode),
+        unknown3=HexDisplayedBytes(unknown3),
+        uptime=uptime,
+        boost=_decode_boost(boost),
+        unknown4=unknown4,
+    )
+
+
+def _encode_ping_request(params: protocol.PingRequest) -> bytes:
+    state = params.state
+    return ping_request.pack(
+        _bits(state.unknown2, 2) << 6
+        | bool(state.load_was_detected_previously) << 5
+        | _bits(_enum(state.advance_mode_state, protocol.AdvanceState), 1) << 4
+        | bool(state.load_detected) << 3
+        | _bits(state.unknown1, 1) << 2
+        | _bits(_enum(state.switch_state, protocol.SwitchState), 2),
+        _raw_bytes(params.unknown2, 3),
+        _enum(params.work_mode, protocol.WorkMode),
+        _raw_bytes(params.unknown3, 3),
+        params.uptime,
+        _encode_boost(params.boost),
+        params.unknown4,
+    )
+
+
+def _decode_ping_response(cls, data: bytes, offset: int) -> protocol.PingResponse:
+    (now,) = struct.unpack_from("<I", data, offset)
+    return cls(now=EPOCH.shift(seconds=now))
+
+
+def encode_timestamp(seconds: float) -> bytes:
+    return struct.pack("<I", int(seconds))
+
+
+def _encode_ping_response(params: protocol.PingResponse) -> bytes:
+    return encode_timestamp((params.now - EPOCH).total_seconds())
+
+
+def _decode_boost_request(cls, data: bytes, offset: int) -> protocol.BoostRequest:
+    return cls(boost_type=protocol.BoostState(data[offset]))
+
+
+def _encode_boost_request(params: protocol.BoostRequest) -> bytes:
+    return struct.pack("<B", _enum(params.boost_type, protocol.BoostState))
+
+
+def _decode_boost_response(cls, data: bytes, offset: int) -> protocol.BoostResponse:
+    expected_finish_time, boost_start_config = struct.unpack_from("<HH", data, offset)
+    return cls(
+        expected_finish_time=_decode_boost(expected_finish_time),
+        boost_start_config=_decode_boost(boost_start_config),
+    )
+
+
+def _encode_boost_response(params: protocol.BoostResponse) -> bytes:
+    return struct.pack(
+        "<HH",
+        _encode_boost(params.expected_finish_time),
+        _encode_boost(params.boost_start_config),
+    )
+
+
+def _decode_code_version(cls, data: bytes, offset: int) -> protocol.CodeVersion:
+    return cls(code_version=_decode_padded_string(data[offset : offset + 13], "ascii"))
+
+
+def _encode_code_version(params: protocol.CodeVersion) -> bytes:
+    return _padded_string(params.code_version, 13, "ascii")
+
+
+def _decode_advance_mode(cls, data: bytes, offset: int) -> protocol.AdvanceModeRequest:
+    # `BitsInteger(1)` outside of a bit-struct consumes a whole byte and treats it as a single bit
+    return cls(mode=protocol.AdvanceState(data[offset]))
+
+
+def _encode_advance_mode(params: protocol.AdvanceModeRequest) -> bytes:
+    return bytes((_bits(_enum(params.mode, protocol.AdvanceState), 1),))
+
+
+def _decode_work_mode(cls, data: bytes, offset: int) -> protocol.SetWorkmodeRequest:
+    return cls(work_mode=protocol.WorkMode(data[offset]))
+
+
+def _encode_work_mode(params: protocol.SetWorkmodeRequest) -> bytes:
+    return struct.pack("<B", _enum(params.work_mode, protocol.WorkMode))
+
+
+def _decode_schedule_id(
+    cls, data: bytes, offset: int
+) -> protocol.GetCurrentScheduleResponse:
+    return cls(schedule_id=data[offset])
+
+
+def _encode_schedule_id(params: protocol.GetCurrentScheduleResponse) -> bytes:
+    return struct.pack("<B", params.schedule_id)
+
+
+schedule = struct.Struct("<HHB1s")
+schedule_info_fields = tuple(
+    "schedule{}".format(i + 1) for i in range(protocol.MAX_SCHEDULES_COUNT)
+)
+
+
+def _decode_schedule_info(
+    cls, data: bytes, offset: int
+) -> protocol.GetScheduleInfoResponse:
+    kwargs = {"schedule_id": data[offset]}
+    offset += 1
+    for field in schedule_info_fields:
+        start, end, repeat, unknown = schedule.unpack_from(data, offset)
+        kwargs[field] = protocol.Schedule(
+            start=_decode_schedule_time(start),
+            end=_decode_schedule_time(end),
+            repeat=protocol.ScheduleRepeats(repeat),
+            unknown=HexDisplayedBytes(unknown),
+        )
+        offset += schedule.size
+
+    kwargs["name"] = _decode_padded_string(data[offset : offset + 50], "utf-8")
+    return cls(**kwargs)
+
+
+def _encode_schedule_info(params: protocol.GetScheduleInfoResponse) -> bytes:
+    ret = [struct.pack("<B", params.schedule_id)]
+    for field in schedule_info_fields:
+        item: protocol.Schedule = getattr(params, field)
+        ret.append(
+            schedule.pack(
+                _encode_schedule_time(item.start),
+                _encode_schedule_time(item.end),
+                _enum(item.repeat, protocol.ScheduleRepeats),
+                _raw_bytes(item.unknown, 1),
+            )
+        )
+    ret.append(_padded_string(params.name, 50, "utf-8"))
+    return b"".join(ret)
+
+
+def encode_schedule_info(params: protocol.GetScheduleInfoResponse) -> bytes:
+    return _encode_schedule_info(params)
+
+
+def decode_schedule_info(data: bytes) -> protocol.GetScheduleInfoResponse:
+    return _decode_schedule_info(protocol.GetScheduleInfoResponse, data, 0)
+
+
+# params class -> (params size, decoder, encoder)
+PARAMS_CODECS: typing.Dict[
+    type, typing.Tuple[int, typing.Callable, typing.Callable]
+] = {
+    protocol.PingRequest: (
+        ping_request.size,
+        _decode_ping_request,
+        _encode_ping_request,
+    ),
+    protocol.PingResponse: (4, _decode_ping_response, _encode_ping_response),
+    protocol.ReportCodeVersionRequest: (13, _decode_code_version, _encode_code_version),
+    protocol.ReportCodeVersionResponse: (
+        13,
+        _decode_code_version,
+        _encode_code_version,
+    ),
+    protocol.GetCodeVersionRequest: (0, _decode_empty, _encode_empty),
+    protocol.GetCodeVersionResponse: (13, _decode_code_version, _encode_code_version),
+    protocol.BoostRequest: (1, _decode_boost_request, _encode_boost_request),
+    protocol.BoostResponse: (4, _decode_boost_response, _encode_boost_response),
+    protocol.AdvanceModeRequest: (1, _decode_advance_mode, _encode_advance_mode),
+    protocol.AdvanceModeResponse: (1, _decode_advance_mode, _encode_advance_mode),
+    protocol.SetWorkmodeRequest: (1, _decode_work_mode, _encode_work_mode),
+    protocol.SetWorkmodeResponse: (1, _decode_work_mode, _encode_work_mode),
+    protocol.GetCurrentScheduleRequest: (0, _decode_empty, _encode_empty),
+    protocol.GetCurrentScheduleResponse: (1, _decode_schedule_id, _encode_schedule_id),
+    protocol.SetCurrentScheduleRequest: (1, _decode_schedule_id, _encode_schedule_id),
+    protocol.SetCurrentScheduleResponse: (1, _decode_schedule_id, _encode_schedule_id),
+    protocol.GetScheduleInfoRequest: (1, _decode_schedule_id, _encode_schedule_id),
+    protocol.GetScheduleInfoResponse: (
+        87,
+        _decode_schedule_info,
+        _encode_schedule_info,
+    ),
+    protocol.SetScheduleInfoRequest: (87, _decode_schedule_info, _encode_schedule_info),
+    protocol.SetScheduleInfoResponse: (
+        87,
+        _decode_schedule_info,
+        _encode_schedule_info,
+    ),
+}
+
+MESSAGE_TYPE_CODECS = {
+    message_type_id: (params_class,) + PARAMS_CODECS[params_class]
+    for message_type_id, params_class in protocol.Payload.MESSAGE_TYPE_MAP.items()
+    if params_class in PARAMS_CODECS
+}
+
+
+PARAMS_SIZES = {
+    params_class: params_format.sizeof()
+    for params_class, params_format in protocol.params_formats.items()
+}
+
+
+def _decode_params(
+    message_type_id: int, params_size: int, payload_raw: bytes
+) -> typing.Any:
+    codec = MESSAGE_TYPE_CODECS.get(message_type_id)
+    if codec is not None:
+        try:
+            return codec[2](codec[0], payload_raw, payload_header.size)
+        except ValueError:
+            # Let construct raise a meaningful error
+            pass
+
+    params_class = protocol.Payload.MESSAGE_TYPE_MAP.get(message_type_id)
+    if params_class is not None:
+        return protocol.params_formats[params_class].parse(
+            payload_raw[payload_header.size :]
+        )
+
+    return HexDumpDisplayedBytes(
+        payload_raw[payload_header.size : payload_header.size + params_size]
+    )
+
+
+class LazyPayload(protocol.Payload):
+    # The header is decoded straight away, `params` only when they're accessed for the first time — routing the packet
+    # doesn't need them.
+
+    def __init__(
+        self,
+        message_type: protocol.MessageType,
+        message_flags: protocol.MessageFlags,
+        message_type_id: int,
+        params_size: int,
+        seq: int,
+        unknown: bytes,
+        device_id: int,
+        payload_raw: bytes,
+    ):
+        self.message_type = message_type
+        self.message_flags = message_flags
+        self.message_type_id = message_type_id
+        self.params_size = params_size
+        self.seq = seq
+        self.unknown = unknown
+        self.device_id = device_id
+        self._payload_raw = payload_raw
+        self._params = None
+
+    @property
+    def params(self) -> typing.Any:
+        if self._params is None:
+            self._params = _decode_params(
+                self.message_type_id, self.params_size, self._payload_raw
+            )
+        return self._params
+
+    @params.setter
+    def params(self, value: typing.Any):
+        self._params = value
+
+    def _as_payload(self) -> protocol.Payload:
+        payload = object.__new__(protocol.Payload)
+        for field in dataclasses.fields(protocol.Payload):
+            setattr(payload, field.name, getattr(self, field.name))
+        return payload
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, protocol.Payload):
+            return NotImplemented
+
+        return all(
+            getattr(self, field.name) == getattr(other, field.name)
+            for field in dataclasses.fields(protocol.Payload)
+        )
+
+    # Printed the same way as the payload parsed by construct
+    def __repr__(self) -> str:
+        return repr(self._as_payload())
+
+    def __str__(self) -> str:
+        return str(self._as_payload())
+
+
+def parse(data: bytes, checksum_verified: bool = False) -> protocol.Timeguard:
+    # Only the framing, the payload header and the checksum (unless it was checked by `crc.verify_frame` already) are
+    # validated here; anything unusual is handed over to construct so it can raise a meaningful error.
+    if len(data) < frame_header.size + payload_header.size + frame_trailer.size:
+        return protocol.format.parse(data)
+
+    header, payload_size, message_id = frame_header.unpack_from(data)
+    payload_end = frame_header.size + payload_size
+    if (
+        header != FRAME_HEADER
+        or payload_size < payload_header.size
+        or len(data) < payload_end + frame_trailer.size
+    ):
+        return protocol.format.parse(data)
+
+    checksum, footer = frame_trailer.unpack_from(data, payload_end)
+    payload_raw = bytes(data[frame_header.size : payload_end])
+    if footer != FRAME_FOOTER or (
+        not checksum_verified and protocol.crc16_xmodem(payload_raw) != checksum
+    ):
+        return protocol.format.parse(data)
+
+    (
+        message_type,
+        message_flags,
+        params_size,
+        seq,
+        unknown,
+        device_id,
+    ) = payload_header.unpack_from(payload_raw)
+    if message_type & 0b11110000 or message_flags & 0b11110000:
+        return protocol.format.parse(data)
+
+    message_type_id = protocol.Payload.get_message_type_id(message_type, message_flags)
+    params_class = protocol.Payload.MESSAGE_TYPE_MAP.get(message_type_id)
+    if payload_size < payload_header.size + (
+        PARAMS_SIZES[params_class] if params_class else params_size
+    ):
+        return protocol.format.parse(data)
+
+    ret = protocol.Timeguard(message_id=HexDisplayedInteger.new(message_id, "08X"))
+    ret.header = HexDisplayedBytes(FRAME_HEADER)
+    ret.payload_size = payload_size
+    ret.payload_raw = HexDisplayedBytes(payload_raw)
+    ret.payload = LazyPayload(
+        message_type=protocol.MessageType(message_type),
+        message_flags=protocol.MessageFlags(message_flags),
+        message_type_id=message_type_id,
+        params_size=params_size,
+        seq=seq,
+        unknown=HexDisplayedBytes(unknown),
+        device_id=HexDisplayedInteger.new(device_id, "08X"),
+        payload_raw=ret.payload_raw,
+    )
+    ret.checksum = HexDisplayedInteger.new(checksum, "04X")
+    ret.footer = HexDisplayedBytes(FRAME_FOOTER)
+
+    return ret
+
+
+def build_params(message_type_id: int, params: typing.Any) -> typing.Optional[bytes]:
+    params_class = protocol.Payload.MESSAGE_TYPE_MAP.get(message_type_id)
+    if params_class is None:
+        # Unknown message types are parsed into raw bytes
+        return bytes(params) if isinstance(params, (bytes, bytearray)) else None
+
+    if not isinstance(params, params_class):
+        return None
+
+    codec = MESSAGE_TYPE_CODECS.get(message_type_id)
+    if codec is None:
+        return protocol.params_formats[params_class].build(params)
+
+    return codec[3](params)
+
+
+def _build_payload(payload: protocol.Payload) -> typing.Optional[bytes]:
+    message_type = _enum(payload.message_type, protocol.MessageType)
+    message_flags = _enum(payload.message_flags, protocol.MessageFlags)
+    if message_type & 0b11110000 or message_flags & 0b11110000:
+        return None
+
+    params_raw = build_params(
+        protocol.Payload.get_message_type_id(message_type, message_flags),
+        payload.params,
+    )
+    if params_raw is None:
+        return None
+
+    return (
+        payload_header.pack(
+            message_type,
+            message_flags,
+            len(params_raw),
+            payload.seq,
+            _raw_bytes(payload.unknown, 3),
+            payload.device_id,
+        )
+        + params_raw
+    )
+
+
+def build_frame(message_id: int, payload_raw: bytes) -> bytes:
+    return b"".join(
+        (
+            frame_header.pack(FRAME_HEADER, len(payload_raw), message_id),
+            payload_raw,
+            frame_trailer.pack(protocol.crc16_xmodem(payload_raw), FRAME_FOOTER),
+        )
+    )
+
+
+def build(data: protocol.Timeguard) -> bytes:
+    # The params and the payload are serialised exactly once, sizes and the checksum are derived from those bytes.
+    try:
+        payload_raw = _build_payload(data.payload)
+        if payload_raw is not None:
+            return build_frame(data.message_id, payload_raw)
+    except (
+        ConstructError,
+        TypeError,
+        ValueError,
+        OverflowError,
+        AttributeError,
+        struct.error,
+    ):
+        pass
+
+    # Let construct either handle the frame or raise a meaningful error
+    return protocol.format.build(data)
+
+
+# Offsets of the variable fields in a frame
+MESSAGE_ID_OFFSET = 4
+SEQ_OFFSET = frame_header.size + 4
+UNKNOWN_OFFSET = SEQ_OFFSET + 1
+PARAMS_OFFSET = frame_header.size + payload_header.size
+
+
+class FrameTemplates:
+    # Pre-built frames per message type, device and params size. A frame is rendered by patching only the variable
+    # fields — message id, seq and params — and the checksum.
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._templates: typing.Dict[typing.Tuple[int, int, int], bytearray] = {}
+
+    def _create(self, message_type_id: int, device_id: int, params_size: int):
+        if len(self._templates) >= self.max_size:
+            # The oldest template goes first, most likely it belongs to a device which isn't around anymore
+            del self._templates[next(iter(self._templates))]
+
+        payload_raw = payload_header.pack(
+            message_type_id & 0x0F,
+            message_type_id >> 4,
+            params_size,
+            0xFF,
+            bytes(3),
+            device_id,
+        ) + bytes(params_size)
+        frame = self._templates[(message_type_id, device_id, params_size)] = bytearray(
+            build_frame(0xFFFFFFFF, payload_raw)
+        )
+
+        return frame
+
+    def render(
+        self,
+        message_type_id: int,
+        device_id: int,
+        seq: int,
+        params_raw: bytes,
+        message_id: int = 0xFFFFFFFF,
+        unknown: bytes = bytes(3),
+    ) -> bytes:
+        frame = self._templates.get((message_type_id, device_id, len(params_raw)))
+        if frame is None:
+            frame = self._create(message_type_id, device_id, len(params_raw))
+
+        params_end = PARAMS_OFFSET + len(params_raw)
+        struct.pack_into("<I", frame, MESSAGE_ID_OFFSET, message_id)
+        frame[SEQ_OFFSET] = seq
+        frame[UNKNOWN_OFFSET : PARAMS_OFFSET - 4] = unknown
+        frame[PARAMS_OFFSET:params_end] = params_raw
+        struct.pack_into(
+            "<H",
+            frame,
+            params_end,
+            protocol.crc16_xmodem(memoryview(frame)[frame_header.size : params_end]),
+        )
+
+        return bytes(frame)
+
+    def build(self, data: protocol.Timeguard) -> bytes:
+        # Same as `build`, for the frames the codec can serialise without construct
+        payload = data.payload
+        try:
+            message_type = _enum(payload.message_type, protocol.MessageType)
+            message_flags = _enum(payload.message_flags, protocol.MessageFlags)
+            if not (message_type & 0b11110000 or message_flags & 0b11110000):
+                message_type_id = protocol.Payload.get_message_type_id(
+                    message_type, message_flags
+                )
+                params_raw = build_params(message_type_id, payload.params)
+                if params_raw is not None:
+                    return self.render(
+                        message_type_id,
+                        payload.device_id,
+                        payload.seq,
+                        params_raw,
+                        data.message_id,
+                        _raw_bytes(payload.unknown, 3),
+                    )
+        except (
+            ConstructError,
+            TypeError,
+            ValueError,
+            OverflowError,
+            AttributeError,
+            struct.error,
+        ):
+            pass
+
+        return build(data)
+
+
+def replace_device_id(data: bytes, device_id: int) -> bytes:
+    # Patches the device id of a raw frame in place and recalculates the checksum, no parsing or building involved
+    _, payload_size, _ = frame_header.unpack_from(data)
+    payload_end = frame_header.size + payload_size
+    if (
+        payload_size < payload_header.size
+        or len(data) != payload_end + frame_trailer.size
+    ):
+        raise ValueError("Malformed frame")
+
+    ret = bytearray(data)
+    struct.pack_into("<I", ret, frame_header.size + payload_header.size - 4, device_id)
+    struct.pack_into(
+        "<H",
+        ret,
+        payload_end,
+        protocol.crc16_xmodem(ret[frame_header.size : payload_end]),
+    )
+
+    return bytes(ret)
+
+
+MESSAGE_TYPE_NAMES = {
+    int(message_type): message_type.name for message_type in protocol.MessageType
+}
+
+
+def peek_message_type(data: bytes) -> typing.Optional[str]:
+    # Name of the message type straight from the raw frame, without parsing it
+    if len(data) <= frame_header.size or data[0:2] != FRAME_HEADER:
+        return None
+
+    return MESSAGE_TYPE_NAMES.get(data[frame_header.size] & 0x0F)
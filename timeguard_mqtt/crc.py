@@ -0,0 +1,134 @@
+import struct
+import typing
+
+import crcmod
+
+try:
+    from crcmod import _crcfunext
+except ImportError:
+    # Pure-python build of crcmod, the table-driven implementation below is faster than its fallback
+    _crcfunext = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Frames are checked before any parsing, so corrupted or hostile datagrams are dropped without decoding them. Layout:
+# header (2), payload size (2), message id (4), payload, CRC16-XMODEM of the payload (2), footer (2).
+
+FRAME_HEADER = b"\xFA\xD4"
+FRAME_FOOTER = b"\x2D\xDF"
+
+frame_header = struct.Struct("<2sHI")
+frame_trailer = struct.Struct("<H2s")
+
+POLY = 0x1021
+
+# Below that many frames of the same size the numpy setup costs more than it saves
+BATCH_THRESHOLD = 16
+
+
+def _make_table(poly: int) -> typing.Tuple[int, ...]:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x8000 else crc << 1) & 0xFFFF
+        table.append(crc)
+
+    return tuple(table)
+
+
+TABLE = _make_table(POLY)
+
+
+def crc16_xmodem_table(data: bytes, crc: int = 0) -> int:
+    table = TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ byte]
+
+    return crc
+
+
+HAS_EXTENSION = _crcfunext is not None
+
+if HAS_EXTENSION:
+    crc16_xmodem = crcmod.mkCrcFun(0x10000 | POLY, rev=False, initCrc=0, xorOut=0)
+else:
+    crc16_xmodem = crc16_xmodem_table
+
+
+def payload_size(data: bytes) -> typing.Optional[int]:
+    # Size of the payload when the framing is valid, the checksum isn't verified here
+    if len(data) < frame_header.size + frame_trailer.size:
+        return None
+
+    header, size, _ = frame_header.unpack_from(data)
+    payload_end = frame_header.size + size
+    if header != FRAME_HEADER or len(data) < payload_end + frame_trailer.size:
+        return None
+
+    if data[payload_end + 2 : payload_end + 4] != FRAME_FOOTER:
+        return None
+
+    return size
+
+
+def verify_frame(data: bytes) -> bool:
+    size = payload_size(data)
+    if size is None:
+        return False
+
+    payload_end = frame_header.size + size
+    (checksum,) = struct.unpack_from("<H", data, payload_end)
+
+    return crc16_xmodem(data[frame_header.size : payload_end]) == checksum
+
+
+def verify_frames(
+    frames: typing.Sequence[bytes], use_numpy: typing.Optional[bool] = None
+) -> typing.List[bool]:
+    # Batch variant, e.g. for replaying captures: frames of the same payload size are checked column by column with
+    # numpy, all of them at once. It beats the table-driven loop, but not the C extension of crcmod, so by default
+    # numpy is used only when the extension is missing.
+    if use_numpy is None:
+        use_numpy = not HAS_EXTENSION
+
+    if numpy is None or not use_numpy or len(frames) < BATCH_THRESHOLD:
+        return [verify_frame(frame) for frame in frames]
+
+    ret = [False] * len(frames)
+    groups: typing.Dict[int, typing.List[int]] = {}
+    for index, frame in enumerate(frames):
+        size = payload_size(frame)
+        if size is not None:
+            groups.setdefault(size, []).append(index)
+
+    table = numpy.array(TABLE, dtype=numpy.uint16)
+    for size, indices in groups.items():
+        if len(indices) < BATCH_THRESHOLD:
+            for index in indices:
+                ret[index] = verify_frame(frames[index])
+            continue
+
+        payload_end = frame_header.size + size
+        payloads = numpy.frombuffer(
+            b"".join(
+                frames[index][frame_header.size : payload_end] for index in indices
+            ),
+            dtype=numpy.uint8,
+        ).reshape(len(indices), size)
+        checksums = numpy.frombuffer(
+            b"".join(frames[index][payload_end : payload_end + 2] for index in indices),
+            dtype="<u2",
+        )
+
+        crc = numpy.zeros(len(indices), dtype=numpy.uint16)
+        for column in payloads.T:
+            crc = (crc << 8) ^ table[(crc >> 8) ^ column]
+
+        for index, valid in zip(indices, (crc == checksums).tolist()):
+            ret[index] = valid
+
+    return ret
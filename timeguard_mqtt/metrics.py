@@ -0,0 +1,342 @@
+import argparse
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import typing
+
+from timeguard_mqtt import log
+
+# Prometheus text format, without the client library. The hot path only bumps numbers in dicts — no locks, so a
+# concurrent increment may occasionally be lost, which is fine for monitoring — everything else happens on scrape.
+
+LabelValues = typing.Tuple[str, ...]
+
+DEFAULT_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence) -> str:
+    if not names:
+        return ""
+
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(name, _escape(str(value)))
+            for name, value in zip(names, values)
+        )
+    )
+
+
+def _format_value(value: float) -> str:
+    if value != value:
+        return "NaN"
+
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: typing.Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: typing.DefaultDict[LabelValues, float] = defaultdict(int)
+        if not self.labels:
+            self.values[()] = 0
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] += amount
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, str, float]]:
+        for label_values, value in list(self.values.items()):
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: hits of every bucket (not cumulative, the last one is +Inf) and the sum
+        self.values: typing.Dict[LabelValues, typing.List] = {}
+
+    def observe(self, value: float, *label_values: str):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, str, float]]:
+        bounds = self.buckets + (float("inf"),)
+        labels = self.labels + ("le",)
+
+        for label_values, counts in list(self.values.items()):
+            counts = list(counts)
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                bucket_labels = _format_labels(
+                    labels, label_values + (_format_value(bound),)
+                )
+                yield self.name + "_bucket", bucket_labels, total
+
+            metric_labels = _format_labels(self.labels, label_values)
+            yield self.name + "_sum", metric_labels, counts[-1]
+            yield self.name + "_count", metric_labels, total
+
+
+class CallbackMetric:
+    # Value taken from the application at scrape time, e.g. a queue length
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        labels: typing.Sequence[str] = (),
+    ):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = tuple(labels)
+        self.callbacks: typing.List[
+            typing.Callable[[], typing.Dict[LabelValues, float]]
+        ] = []
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, str, float]]:
+        for callback in self.callbacks:
+            try:
+                values = callback()
+            except Exception:
+                log.exception("Failed to collect %s", self.name)
+                continue
+
+            for label_values, value in values.items():
+                yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: typing.List[typing.Union[Counter, Histogram, CallbackMetric]] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: typing.Sequence[str] = ()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(
+        self, name: str, help: str, type: str, labels: typing.Sequence[str] = ()
+    ):
+        return self.register(CallbackMetric(name, help, type, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, _format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PACKETS_RECEIVED = REGISTRY.counter(
+    "timeguard_packets_received_total",
+    "UDP packets received, by the sender and the message type.",
+    ("direction", "message_type"),
+)
+PACKETS_SENT = REGISTRY.counter(
+    "timeguard_packets_sent_total",
+    "UDP packets sent, by the recipient and the message type.",
+    ("direction", "message_type"),
+)
+PARSE_FAILURES = REGISTRY.counter(
+    "timeguard_parse_failures_total",
+    "Packets which couldn't be parsed (failed) or have an unknown message type (unknown).",
+    ("result",),
+)
+PARSE_SECONDS = REGISTRY.histogram(
+    "timeguard_parse_seconds",
+    "Time spent on parsing the received packets.",
+)
+BUILD_SECONDS = REGISTRY.histogram(
+    "timeguard_build_seconds",
+    "Time spent on building the packets to send.",
+)
+HANDLE_SECONDS = REGISTRY.histogram(
+    "timeguard_handle_seconds",
+    "Time spent on handling a packet, by the thread.",
+    ("stage",),
+)
+MQTT_PUBLISHES = REGISTRY.counter(
+    "timeguard_mqtt_publishes_total",
+    "Messages published to the MQTT broker.",
+)
+MQTT_PUBLISHES_COALESCED = REGISTRY.counter(
+    "timeguard_mqtt_publishes_coalesced_total",
+    "Publishes replaced by a newer value for the same topic before they were sent.",
+)
+QUEUE_DEPTH = REGISTRY.callback(
+    "timeguard_queue_depth",
+    "Number of events waiting in the inter-thread queues.",
+    "gauge",
+    ("queue",),
+)
+QUEUE_HIGH_WATER = REGISTRY.callback(
+    "timeguard_queue_high_water",
+    "Largest number of events that have been waiting in the inter-thread queues at once.",
+    "gauge",
+    ("queue",),
+)
+QUEUE_OVERFLOWS = REGISTRY.callback(
+    "timeguard_queue_overflows_total",
+    "Events added to a full inter-thread queue: dropped, or waited for the room in case of the commands.",
+    "counter",
+    ("queue",),
+)
+QUEUE_COALESCED = REGISTRY.callback(
+    "timeguard_queue_coalesced_total",
+    "Pings replaced in the queue by a newer one of the same device.",
+    "counter",
+    ("queue",),
+)
+WAITING_FOR_RESPONSE = REGISTRY.callback(
+    "timeguard_waiting_for_response",
+    "Commands sent to the devices and not confirmed yet.",
+    "gauge",
+)
+RETRANSMISSIONS = REGISTRY.callback(
+    "timeguard_retransmissions_total",
+    "Outcomes of the commands sent to the devices: resent, expired or acknowledged.",
+    "counter",
+    ("result",),
+)
+
+
+def _queue_size(queue) -> float:
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        # multiprocessing.Queue on macOS
+        return float("nan")
+
+
+def _queue_stats(queues: dict, attribute: str) -> typing.Dict[LabelValues, float]:
+    return {
+        (name,): getattr(queue, attribute)
+        for name, queue in queues.items()
+        if hasattr(queue, attribute)
+    }
+
+
+def watch_queues(**queues):
+    QUEUE_DEPTH.callbacks.append(
+        lambda: {(name,): _queue_size(queue) for name, queue in queues.items()}
+    )
+    QUEUE_HIGH_WATER.callbacks.append(lambda: _queue_stats(queues, "high_water"))
+    QUEUE_OVERFLOWS.callbacks.append(lambda: _queue_stats(queues, "overflows"))
+    QUEUE_COALESCED.callbacks.append(lambda: _queue_stats(queues, "coalesced"))
+
+
+def watch_retransmissions(scheduler):
+    WAITING_FOR_RESPONSE.callbacks.append(lambda: {(): len(scheduler)})
+    RETRANSMISSIONS.callbacks.append(
+        lambda: {
+            ("resent",): scheduler.resends,
+            ("expired",): scheduler.expiries,
+            ("acknowledged",): scheduler.acknowledgements,
+        }
+    )
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Metrics request: " + format, *args)
+
+
+class MetricsServer:
+    def __init__(self, address: str, port: int):
+        self._server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        log.info(
+            "Serving metrics on http://%s:%d/metrics", *self._server.server_address[:2]
+        )
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def prepare_argparse(parser: argparse._ActionsContainer):
+    parser.add_argument(
+        "--metrics-port",
+        help="Serve Prometheus metrics over HTTP on the port, disabled by default.",
+        type=int,
+    )
+    parser.add_argument(
+        "--metrics-address",
+        help="Address to serve the metrics on.",
+        default="127.0.0.1",
+    )
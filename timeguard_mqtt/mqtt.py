@@ -1,14 +1,46 @@
 import argparse
 from datetime import datetime
+from functools import partial
 import json
-from queue import Empty as QueueEmptyError, Queue
-from time import sleep, time
+from queue import Empty as QueueEmptyError, Full as QueueFullError, Queue
+from time import monotonic, perf_counter, sleep
 from typing import Optional
 
 from dateutil.relativedelta import SU, relativedelta
 import paho.mqtt.client as mqtt
 
-from timeguard_mqtt import log, protocol
+from timeguard_mqtt import codec, log, metrics, protocol
+from timeguard_mqtt.publisher import PublishCoalescer
+from timeguard_mqtt.queries import QueryTracker
+from timeguard_mqtt.registry import DeviceRegistry
+from timeguard_mqtt.router import WILDCARD, TopicRouter
+from timeguard_mqtt.store import DeviceStore
+
+
+class DeviceTopics:
+    # Topics and ids of a device, formatted once instead of on every publish
+    __slots__ = ("name", "base", "unique_id", "_topics", "_unique_ids")
+
+    def __init__(self, root_topic: str, device_id: int):
+        self.name = "{:08x}".format(device_id)
+        self.base = "{}/{}".format(root_topic, self.name)
+        self.unique_id = "timeguard_{}".format(self.name)
+        self._topics = {"": self.base}
+        self._unique_ids = {}
+
+    def topic(self, topic: str) -> str:
+        ret = self._topics.get(topic)
+        if ret is None:
+            ret = self._topics[topic] = "{}/{}".format(self.base, topic)
+
+        return ret
+
+    def sensor_unique_id(self, sensor: str) -> str:
+        ret = self._unique_ids.get(sensor)
+        if ret is None:
+            ret = self._unique_ids[sensor] = "{}_{}".format(self.unique_id, sensor)
+
+        return ret
 
 
 class Mqtt:
@@ -29,12 +61,70 @@ class Mqtt:
 
     WORK_MODE_MAP_REVERSE = dict(zip(WORK_MODE_MAP.values(), WORK_MODE_MAP.keys()))
 
-    def __init__(self, args, network_events_queue: Queue, mqtt_events_queue: Queue):
+    # Parameters saved to the device store, the rest is reported by the devices with every ping
+    STORED_PARAMETERS = ("code_version", "active_schedule_id")
+
+    def __init__(
+        self,
+        args,
+        network_events_queue: Queue,
+        mqtt_events_queue: Queue,
+        device_store: Optional[DeviceStore] = None,
+    ):
         self.args = args
         self.network_events_queue = network_events_queue
         self.mqtt_events_queue = mqtt_events_queue
+        self.device_store = device_store
         self.client = None
-        self._device_state = {}
+        self._device_state = self.create_device_registry()
+        self._device_topics = {}
+        self._topics = {}
+        # Hashes of the retained discovery configs the broker has, by the device and the topic
+        self._discovery_published = {}
+        # Entities of every device for the device-based discovery
+        self._hass_components = {}
+        self.publisher = PublishCoalescer(
+            self.publish_now, args.publish_window, args.publish_rate_limit
+        )
+        self._queries = QueryTracker(args.query_backoff, args.query_max_backoff)
+        self._protocol_handlers = self.build_protocol_handlers()
+        self._topic_router = self.build_topic_router()
+
+    def build_protocol_handlers(self) -> dict:
+        # handle_{client|server}_{message type} methods, by (is_from_server, message_type)
+        handlers = {}
+        for message_type in protocol.MessageType:
+            for is_from_server in (False, True):
+                callback = getattr(
+                    self,
+                    "handle_{}_{}".format(
+                        "server" if is_from_server else "client",
+                        message_type.name.lower(),
+                    ),
+                    None,
+                )
+                if callback is not None:
+                    handlers[(is_from_server, message_type)] = callback
+
+        return handlers
+
+    def build_topic_router(self) -> TopicRouter:
+        # on_message_set_{command} methods handle {root}/{device}/{command}/set
+        router = TopicRouter()
+        for name in dir(self):
+            if name.startswith("on_message_set_"):
+                router.add(
+                    self.topic(
+                        "{}/{}/set".format(WILDCARD, name[len("on_message_set_") :])
+                    ),
+                    partial(self.on_device_message, getattr(self, name)),
+                )
+
+        router.add(
+            self.args.homeassistant_status_topic, self.on_message_homeassistant_status
+        )
+
+        return router
 
     def prepare_argparse(parser: argparse._ActionsContainer):
         parser.add_argument("--mqtt-host")
@@ -53,11 +143,31 @@ class Mqtt:
         parser.add_argument(
             "--homeassistant-status-topic", default="homeassistant/status"
         )
+        # "device" announces all the entities of a device with a single config
+        parser.add_argument(
+            "--homeassistant-discovery-mode",
+            choices=["entity", "device"],
+            default="entity",
+        )
         parser.add_argument("--device-online-timeout", default=50, type=int)
+        # Devices to keep track of, the least recently seen ones are forgotten first; 0 for no limit
+        parser.add_argument("--max-devices", default=10000, type=int)
+        # Unchanged states are published again after that many seconds, 0 to publish only the changes
+        parser.add_argument("--state-max-age", default=0, type=int)
+        parser.add_argument("--uptime-interval", default=300, type=int)
+        # Seconds to hold a publish for, newer values for the same topic replace the pending one
+        parser.add_argument("--publish-window", default=0, type=float)
+        # Maximum publishes per second, 0 for no limit
+        parser.add_argument("--publish-rate-limit", default=0, type=float)
+        # Seconds to wait for an answer to a query before asking the device again, doubles with every attempt
+        parser.add_argument("--query-backoff", default=10, type=float)
+        parser.add_argument("--query-max-backoff", default=300, type=float)
 
     def run(self):
         self._stop = False
-        self._device_state = {}
+        self._device_state = self.create_device_registry()
+        self._device_topics = {}
+        self._discovery_published = {}
 
         if not self.args.mqtt_host:
             return
@@ -73,6 +183,10 @@ class Mqtt:
 
         self.client.will_set(self.topic("lwt"), payload="offline", retain=True)
 
+        # Held until the connection is established, so a broker outage doesn't make the MQTT client queue up
+        # everything that's published meanwhile
+        self.publisher.pause()
+
         self.client.connect_async(self.args.mqtt_host, self.args.mqtt_port)
         self.client.loop_start()
 
@@ -81,36 +195,57 @@ class Mqtt:
         while not self._stop:
             try:
                 tg_data: protocol.Timeguard = self.network_events_queue.get_nowait()
+                started_at = perf_counter()
                 self.handle_protocol_data(tg_data)
+                metrics.HANDLE_SECONDS.observe(perf_counter() - started_at, "mqtt")
             except QueueEmptyError:
                 sleep(0.1)
             except:
                 log.exception("Failed to process network message")
 
-            devices_to_delete = []
-            for device_id, state in self._device_state.items():
-                if time() - state["last_command"] > self.args.device_online_timeout:
-                    self.report_offline(self.device_topic(device_id, "lwt"))
-                    devices_to_delete.append(device_id)
+            self.publisher.flush()
 
-            for device_id in devices_to_delete:
-                del self._device_state[device_id]
+            self._device_state.expire()
 
         self.report_offline(self.topic("lwt"))
 
         for device_id in self._device_state.keys():
             self.report_offline(self.device_topic(device_id, "lwt"))
 
+        self.publisher.flush(force=True)
         self.client.disconnect()
         self.client.loop_stop()
 
+    def create_device_registry(self) -> DeviceRegistry:
+        return DeviceRegistry(
+            self.args.device_online_timeout,
+            self.args.max_devices,
+            on_evict=self.on_device_evicted,
+        )
+
+    def on_device_evicted(self, device_id: int, state: dict):
+        # The device went offline (or too many newer ones are around), everything known about it goes away
+        self.report_offline(self.device_topic(device_id, "lwt"))
+        self._device_topics.pop(device_id, None)
+        self._queries.forget(device_id)
+        self._hass_components.pop(device_id, None)
+        self._discovery_published.pop(device_id, None)
+
     def on_disconnect(self, client: mqtt.Client, userdata, rc):
         if rc != mqtt.MQTT_ERR_SUCCESS:
+            self.publisher.pause()
             log.warning("Unexpected MQTT disconnection. Will auto-reconnect.")
             client.connect_async(self.args.mqtt_host, self.args.mqtt_port)
 
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        self.publisher.put(topic, payload, qos, retain)
+
+    def publish_now(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        metrics.MQTT_PUBLISHES.inc()
+        self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+
     def report_offline(self, topic: str):
-        self.client.publish(topic, payload="offline", retain=True)
+        self.publish(topic, payload="offline", retain=True)
 
     def handle_client_ping(self, payload: protocol.Payload):
         device_id = payload.device_id
@@ -175,32 +310,56 @@ class Mqtt:
             "boost_duration_left",
         )
 
-        # Request code_version from the device if it's unknown
+        # Request whatever is still unknown, unless it has been asked for recently
+        queries = self._queries
         if not self.has_parameter(device_id, "code_version"):
-            data = protocol.Timeguard.prepare(
-                protocol.MessageType.CODE_VERSION,
-                protocol.MessageFlags.server(False),
-                device_id,
-            )
-            self.mqtt_events_queue.put(data)
+            if queries.should_send(device_id, protocol.MessageType.CODE_VERSION):
+                data = protocol.Timeguard.prepare(
+                    protocol.MessageType.CODE_VERSION,
+                    protocol.MessageFlags.server(False),
+                    device_id,
+                )
+                self.send_query(data)
 
-        if not self.has_parameter(device_id, "active_schedule"):
-            data = protocol.Timeguard.prepare(
-                protocol.MessageType.ACTIVE_SCHEDULE,
-                protocol.MessageFlags.server(False),
-                device_id,
-            )
-            self.mqtt_events_queue.put(data)
+        if not self.has_parameter(device_id, "active_schedule_id"):
+            if queries.should_send(device_id, protocol.MessageType.ACTIVE_SCHEDULE):
+                data = protocol.Timeguard.prepare(
+                    protocol.MessageType.ACTIVE_SCHEDULE,
+                    protocol.MessageFlags.server(False),
+                    device_id,
+                )
+                self.send_query(data)
 
-        if not self.has_all_schedules(device_id):
-            for schedule_id in range(0, protocol.MAX_SCHEDULES_COUNT):
+        schedules = self._device_state[device_id]["schedules"]
+        for schedule_id in range(0, protocol.MAX_SCHEDULES_COUNT):
+            if schedule_id in schedules:
+                continue
+
+            if queries.should_send(
+                device_id, protocol.MessageType.SCHEDULE, schedule_id
+            ):
                 data = protocol.Timeguard.prepare(
                     protocol.MessageType.SCHEDULE,
                     protocol.MessageFlags.server(False),
                     device_id,
                     schedule_id=schedule_id,
                 )
-                self.mqtt_events_queue.put(data)
+                self.send_query(data)
+
+    def send_query(self, data: protocol.Timeguard):
+        # Queries are asked again once their backoff runs out, so they're dropped rather than waited for
+        try:
+            self.mqtt_events_queue.put_nowait(data)
+        except QueueFullError:
+            log.debug(
+                "Commands queue is full, dropping the %s query to %08x",
+                data.payload.message_type.name,
+                data.payload.device_id,
+            )
+
+    def send_command(self, data: protocol.Timeguard):
+        # The commands queue never makes the users' commands wait, so the MQTT client's thread isn't stalled
+        self.mqtt_events_queue.put(data)
 
     def handle_client_code_version(self, payload: protocol.Payload):
         if payload.message_flags & protocol.MessageFlags.IS_UPDATE_REQUEST == 0:
@@ -213,6 +372,7 @@ class Mqtt:
         device_id = payload.device_id
 
         self.update_device_state(device_id, "code_version", code_version)
+        self._queries.answered(device_id, protocol.MessageType.CODE_VERSION)
         self.report_state(device_id, "code_version")
 
         # Re-announce all the sensors after code_version is received
@@ -247,29 +407,21 @@ class Mqtt:
         device_id = payload.device_id
 
         self.update_schedule(device_id, payload_params)
+        self._queries.answered(
+            device_id, protocol.MessageType.SCHEDULE, payload_params.schedule_id
+        )
 
+        sensor_configured = False
         if self.has_all_schedules(device_id):
-            schedules = []
-            for i in range(0, protocol.MAX_SCHEDULES_COUNT):
-                schedule = self._device_state[device_id]["schedules"][i]
-                if schedule.name:
-                    schedules += [self.get_schedule_name(device_id, i)]
-
             if self.args.homeassistant_discovery:
-                self.configure_hass_sensor(
-                    device_id,
-                    "select",
-                    "active_schedule",
-                    "Active schedule",
-                    command_topic="~/active_schedule/set",
-                    options=schedules,
-                    entity_category="config",
-                )
+                self.configure_hass_active_schedule(device_id)
+                self.publish_hass_device(device_id)
+                sensor_configured = True
 
             if self.has_parameter(device_id, "active_schedule_id"):
                 self.update_active_schedule(device_id)
 
-        self.report_state(device_id, "active_schedule")
+        self.report_state(device_id, "active_schedule", force=sensor_configured)
 
     def handle_client_active_schedule(self, payload: protocol.Payload):
         if payload.message_flags & protocol.MessageFlags.IS_UPDATE_REQUEST == 0:
@@ -282,6 +434,7 @@ class Mqtt:
         device_id = payload.device_id
 
         self.update_device_state(device_id, "active_schedule_id", active_schedule_id)
+        self._queries.answered(device_id, protocol.MessageType.ACTIVE_SCHEDULE)
 
         if self.has_all_schedules(device_id):
             self.update_active_schedule(device_id)
@@ -299,36 +452,68 @@ class Mqtt:
             device_id,
             schedule_id=schedule_id,
         )
-        self.mqtt_events_queue.put(data)
+        self.send_query(data)
 
     def handle_protocol_data(self, data: protocol.Timeguard):
         payload = data.payload
         device_id = payload.device_id
-        if payload.message_flags & protocol.MessageFlags.IS_FROM_SERVER == 0:
+        is_from_server = bool(
+            payload.message_flags & protocol.MessageFlags.IS_FROM_SERVER
+        )
+        if not is_from_server:
             if device_id not in self._device_state:
+                self._device_topics[device_id] = DeviceTopics(
+                    self.args.mqtt_root_topic, device_id
+                )
                 self._device_state[device_id] = {
                     "parameters": {},
                     "schedules": {},
+                    # Values last sent to MQTT, with the time they were sent at
+                    "published": {},
                 }
+                self.restore_device(device_id)
                 self.setup_device(device_id)
+                # Whatever has been restored and not published by the setup already
+                self.report_state(device_id)
 
-            self._device_state[device_id]["last_command"] = time()
-
-        callback_name = "handle_{}_{}".format(
-            "client"
-            if payload.message_flags & protocol.MessageFlags.IS_FROM_SERVER == 0
-            else "server",
-            payload.message_type.name.lower(),
-        )
+            self._device_state.touch(device_id)
 
-        if hasattr(self, callback_name):
-            getattr(self, callback_name)(payload)
+        callback = self._protocol_handlers.get((is_from_server, payload.message_type))
+        if callback is not None:
+            callback(payload)
 
-    def report_state(self, device_id: int, *params_to_report):
+    def report_state(self, device_id: int, *params_to_report, force: bool = False):
+        now = monotonic()
+        topics = self.device_topics(device_id)
+        published = self._device_state[device_id]["published"]
         for key, value in self._device_state[device_id]["parameters"].items():
             if params_to_report and key not in params_to_report:
                 continue
-            self.client.publish(self.device_topic(device_id, key), payload=value, qos=1)
+
+            if not force and not self.is_state_outdated(
+                published.get(key), key, value, now
+            ):
+                continue
+
+            self.publish(topics.topic(key), payload=value, qos=1)
+            published[key] = (value, now)
+
+    def is_state_outdated(
+        self, last_published: Optional[tuple], parameter: str, value, now: float
+    ) -> bool:
+        if last_published is None:
+            return True
+
+        last_value, published_at = last_published
+        age = now - published_at
+        if parameter == "uptime":
+            # Changes every time, so it's reported with its own coarse interval
+            return age >= self.args.uptime_interval
+
+        if last_value != value:
+            return True
+
+        return bool(self.args.state_max_age) and age >= self.args.state_max_age
 
     def has_all_schedules(self, device_id: int) -> bool:
         return (
@@ -341,14 +526,64 @@ class Mqtt:
     ):
         self._device_state[device_id]["schedules"][schedule.schedule_id] = schedule
 
+        if self.device_store is not None:
+            self.device_store.save_schedule(
+                device_id, schedule.schedule_id, codec.encode_schedule_info(schedule)
+            )
+
     def has_parameter(self, device_id: int, parameter: str) -> bool:
         return parameter in self._device_state[device_id]["parameters"]
 
     def update_device_state(self, device_id: int, parameter: str, value: any):
-        self._device_state[device_id]["parameters"][parameter] = value
+        parameters = self._device_state[device_id]["parameters"]
+        if (
+            self.device_store is not None
+            and parameter in self.STORED_PARAMETERS
+            and parameters.get(parameter) != value
+        ):
+            self.device_store.save_parameter(device_id, parameter, value)
+
+        parameters[parameter] = value
+
+    def restore_device(self, device_id: int):
+        # What was known before the restart, so the device doesn't need to be queried again
+        if self.device_store is None:
+            return
+
+        try:
+            parameters, schedules = self.device_store.load(device_id)
+            state = self._device_state[device_id]
+            state["parameters"].update(
+                (key, value)
+                for key, value in parameters.items()
+                if key in self.STORED_PARAMETERS
+            )
+            for schedule_id, data in schedules.items():
+                state["schedules"][schedule_id] = codec.decode_schedule_info(data)
+        except:
+            log.exception(
+                "Failed to restore the state of %s", self.format_device(device_id)
+            )
+            return
+
+        if self.has_all_schedules(device_id):
+            self.update_active_schedule(device_id)
 
     def topic(self, topic: str) -> str:
-        return "{}/{}".format(self.args.mqtt_root_topic, topic)
+        ret = self._topics.get(topic)
+        if ret is None:
+            ret = self._topics[topic] = "{}/{}".format(self.args.mqtt_root_topic, topic)
+
+        return ret
+
+    def device_topics(self, device_id: int) -> DeviceTopics:
+        topics = self._device_topics.get(device_id)
+        if topics is None:
+            topics = self._device_topics[device_id] = DeviceTopics(
+                self.args.mqtt_root_topic, device_id
+            )
+
+        return topics
 
     def setup_device(self, device_id: int):
         self.client.subscribe(self.device_topic(device_id, "+/set"))
@@ -408,6 +643,32 @@ class Mqtt:
             options=list(self.WORK_MODE_MAP.values()),
             entity_category="config",
         )
+        if self.has_all_schedules(device_id):
+            self.configure_hass_active_schedule(device_id)
+        self.publish_hass_device(device_id)
+
+        self.publish(self.topic("lwt"), payload="online", qos=1)
+        self.publish(self.device_topic(device_id, "lwt"), payload="online", qos=1)
+
+        # The entities might have been just created, they need the current state
+        self.report_state(device_id, force=True)
+
+    def configure_hass_active_schedule(self, device_id: int):
+        schedules = []
+        for i in range(0, protocol.MAX_SCHEDULES_COUNT):
+            schedule = self._device_state[device_id]["schedules"][i]
+            if schedule.name:
+                schedules += [self.get_schedule_name(device_id, i)]
+
+        self.configure_hass_sensor(
+            device_id,
+            "select",
+            "active_schedule",
+            "Active schedule",
+            command_topic="~/active_schedule/set",
+            options=schedules,
+            entity_category="config",
+        )
 
     def get_device_parameter(self, device_id: int, parameter: str, default=None) -> any:
         return (
@@ -427,9 +688,7 @@ class Mqtt:
 
         return None
 
-    def configure_hass_sensor(
-        self, device_id: int, sensor_type: str, sensor_id: str, name: str, **kwargs
-    ):
+    def hass_device(self, device_id: int) -> dict:
         device = {
             "identifiers": ["tg:{}".format(device_id)],
             "manufacturer": "Timeguard",
@@ -440,46 +699,91 @@ class Mqtt:
             device["model"] = device_version[0]
             device["sw_version"] = device_version[1]
 
-        self.client.publish(
-            self.hass_topic(
-                "{}/{}/config".format(
-                    sensor_type, self.discovery_unique_id(device_id, sensor_id)
-                )
-            ),
-            payload=json.dumps(
+        return device
+
+    def hass_availability(self) -> list:
+        return [
+            {
+                "topic": "~/lwt",
+                "payload_available": "online",
+                "payload_not_available": "offline",
+            },
+            {
+                "topic": self.topic("lwt"),
+                "payload_available": "online",
+                "payload_not_available": "offline",
+            },
+        ]
+
+    def configure_hass_sensor(
+        self, device_id: int, sensor_type: str, sensor_id: str, name: str, **kwargs
+    ):
+        device = self.hass_device(device_id)
+        unique_id = self.discovery_unique_id(device_id, sensor_id)
+        name = "{} {}".format(device["name"], name)
+        state_topic = "~/{}".format(sensor_id)
+
+        if self.args.homeassistant_discovery_mode == "device":
+            # Sent along with the other entities by publish_hass_device
+            self._hass_components.setdefault(device_id, {})[sensor_id] = {
+                "platform": sensor_type,
+                "unique_id": unique_id,
+                "name": name,
+                "state_topic": state_topic,
+            } | kwargs
+            return
+
+        self.publish_discovery(
+            device_id,
+            self.hass_topic("{}/{}/config".format(sensor_type, unique_id)),
+            json.dumps(
                 {
                     "~": self.device_topic(device_id, ""),
-                    "unique_id": self.discovery_unique_id(device_id, sensor_id),
-                    "availability": [
-                        {
-                            "topic": "~/lwt",
-                            "payload_available": "online",
-                            "payload_not_available": "offline",
-                        },
-                        {
-                            "topic": self.topic("lwt"),
-                            "payload_available": "online",
-                            "payload_not_available": "offline",
-                        },
-                    ],
+                    "unique_id": unique_id,
+                    "availability": self.hass_availability(),
                     "availability_mode": "all",
-                    "name": "{} {}".format(device["name"], name),
-                    "state_topic": "~/{}".format(sensor_id),
+                    "name": name,
+                    "state_topic": state_topic,
                     "device": device,
                 }
                 | kwargs
             ),
-            qos=1,
-            retain=True,
         )
 
-        self.client.publish(self.topic("lwt"), payload="online", qos=1)
-        self.client.publish(
-            self.device_topic(device_id, "lwt"), payload="online", qos=1
+    def publish_hass_device(self, device_id: int):
+        if self.args.homeassistant_discovery_mode != "device":
+            return
+
+        self.publish_discovery(
+            device_id,
+            self.hass_topic(
+                "device/{}/config".format(self.device_topics(device_id).unique_id)
+            ),
+            json.dumps(
+                {
+                    "~": self.device_topic(device_id, ""),
+                    "device": self.hass_device(device_id),
+                    "origin": {"name": "timeguard-mqtt"},
+                    "availability": self.hass_availability(),
+                    "availability_mode": "all",
+                    "components": self._hass_components.get(device_id, {}),
+                },
+                separators=(",", ":"),
+            ),
         )
 
+    def publish_discovery(self, device_id: int, topic: str, payload: str):
+        # The configs are retained, so the broker keeps them until they change
+        published = self._discovery_published.setdefault(device_id, {})
+        digest = hash(payload)
+        if published.get(topic) == digest:
+            return
+
+        self.publish(topic, payload=payload, qos=1, retain=True)
+        published[topic] = digest
+
     def discovery_unique_id(self, device_id: int, sensor: str) -> str:
-        return "timeguard_{}_{}".format(self.format_device(device_id), sensor)
+        return self.device_topics(device_id).sensor_unique_id(sensor)
 
     def hass_topic(self, topic: str) -> Optional[str]:
         if self.args.homeassistant_discovery:
@@ -488,30 +792,30 @@ class Mqtt:
         return None
 
     def format_device(self, device_id: int) -> str:
-        return "{:08x}".format(device_id)
+        return self.device_topics(device_id).name
 
     def device_topic(self, device_id: int, topic: str) -> str:
-        if topic:
-            return self.topic("{}/{}".format(self.format_device(device_id), topic))
-
-        return self.topic("{}".format(self.format_device(device_id)))
+        return self.device_topics(device_id).topic(topic)
 
     def on_connect(self, client: mqtt.Client, userdata, flags, rc):
         log.info("MQTT connection established.")
+        self.publisher.resume()
+
+        if not flags.get("session present"):
+            # Can't tell what the broker has kept, announce everything again
+            self._discovery_published.clear()
 
         for device_id in self._device_state.keys():
             self.setup_device(device_id)
 
         if self.args.homeassistant_discovery:
             client.subscribe(self.args.homeassistant_status_topic)
-        client.publish(self.topic("lwt"), payload="online", qos=1)
+        self.publish(self.topic("lwt"), payload="online", qos=1)
 
     def on_message_set_raw_command(
         self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage, device_id: int
     ):
-        self.mqtt_events_queue.put(
-            protocol.format.parse(bytes.fromhex(msg.payload.decode("ascii")))
-        )
+        self.send_command(codec.parse(bytes.fromhex(msg.payload.decode("ascii"))))
 
     def on_message_set_active_schedule(
         self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage, device_id: int
@@ -535,7 +839,7 @@ class Mqtt:
             device_id,
             schedule_id=int(schedule_name[1]) - 1,
         )
-        self.mqtt_events_queue.put(data)
+        self.send_command(data)
 
         # This is needed to keep Cloudward server in sync with the device
         data = protocol.Timeguard.prepare(
@@ -543,7 +847,7 @@ class Mqtt:
             protocol.MessageFlags.server(False),
             device_id,
         )
-        self.mqtt_events_queue.put(data)
+        self.send_command(data)
 
     def on_message_set_boost(
         self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage, device_id: int
@@ -559,7 +863,7 @@ class Mqtt:
             device_id,
             boost_type=boost,
         )
-        self.mqtt_events_queue.put(data)
+        self.send_command(data)
 
     def on_message_set_advance_mode(
         self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage, device_id: int
@@ -575,7 +879,7 @@ class Mqtt:
             device_id,
             mode=advance,
         )
-        self.mqtt_events_queue.put(data)
+        self.send_command(data)
 
     def on_message_set_work_mode(
         self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage, device_id: int
@@ -591,30 +895,35 @@ class Mqtt:
             device_id,
             work_mode=work_mode,
         )
-        self.mqtt_events_queue.put(data)
+        self.send_command(data)
 
-    def on_message(self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage):
-        last_3_parts = msg.topic.split("/")[-3:]
-        device_id = last_3_parts[0]
-        on_message_callback_name = "on_message_" + "_".join(last_3_parts[-2:][::-1])
-        if len(last_3_parts) == 3 and hasattr(self, on_message_callback_name):
-            try:
-                getattr(self, on_message_callback_name)(
-                    client, userdata, msg, int(device_id, 16)
-                )
-            except:
-                log.exception("Failed to handle MQTT message")
-        elif (
-            msg.topic == self.args.homeassistant_status_topic
-            and msg.payload == b"online"
-        ):
+    def on_device_message(
+        self, callback, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage, device
+    ):
+        callback(client, userdata, msg, int(device, 16))
+
+    def on_message_homeassistant_status(
+        self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage
+    ):
+        if msg.payload == b"online":
             # We need to repeat non-retainable topics when HASS restarted
-            client.publish(self.topic("lwt"), payload="online", qos=1)
+            self.publish(self.topic("lwt"), payload="online", qos=1)
             for device_id in self._device_state.keys():
-                client.publish(
+                self.publish(
                     self.device_topic(device_id, "lwt"), payload="online", qos=1
                 )
-                self.report_state(device_id)
+                self.report_state(device_id, force=True)
+
+    def on_message(self, client: mqtt.Client, userdata, msg: mqtt.MQTTMessage):
+        route = self._topic_router.match(msg.topic)
+        if route is None:
+            return
+
+        callback, params = route
+        try:
+            callback(client, userdata, msg, *params)
+        except:
+            log.exception("Failed to handle MQTT message")
 
     def stop(self):
         self._stop = True
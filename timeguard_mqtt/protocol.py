@@ -35,9 +35,8 @@ from construct_typed import (
     TFlagsEnum,
     csfield,
 )
-import crcmod
 
-crc16_xmodem = crcmod.mkCrcFun(0x11021, rev=False, initCrc=0x0000, xorOut=0x0000)
+from timeguard_mqtt.crc import crc16_xmodem
 
 MAX_SCHEDULES_COUNT = 6
 
@@ -364,11 +363,7 @@ class Payload(DataclassMixin):
     params_size: int = csfield(
         Rebuild(
             Int16ul,
-            lambda ctx: len(
-                DataclassStruct(ctx.params.__class__).build(ctx.params)
-                if isinstance(ctx.params, DataclassMixin)
-                else ctx.params
-            ),
+            lambda ctx: len(build_params(ctx.params)),
         )
     )
     seq: int = csfield(Int8ul)
@@ -392,13 +387,13 @@ class Payload(DataclassMixin):
 class Timeguard(DataclassMixin):
     header: bytes = csfield(Hex(Const(b"\xFA\xD4")))
     payload_size: int = csfield(
-        Rebuild(Int16ul, lambda ctx: len(DataclassStruct(Payload).build(ctx.payload)))
+        Rebuild(Int16ul, lambda ctx: len(payload_format.build(ctx.payload)))
     )
     message_id: int = csfield(Hex(Int32ul))
     payload_raw: bytes = csfield(
         Rebuild(
             Hex(Bytes(this.payload_size)),
-            lambda ctx: DataclassStruct(Payload).build(ctx.payload),
+            lambda ctx: payload_format.build(ctx.payload),
         )
     )
     payload: Payload = csfield(RestreamData(this.payload_raw, DataclassStruct(Payload)))
@@ -454,4 +449,22 @@ class Timeguard(DataclassMixin):
         return ret
 
 
+params_formats = {
+    params_class: DataclassStruct(params_class)
+    for params_class in set(Payload.MESSAGE_TYPE_MAP.values())
+}
+
+
+def build_params(params: typing.Any) -> bytes:
+    if not isinstance(params, DataclassMixin):
+        return params
+
+    params_format = params_formats.get(params.__class__)
+    if params_format is None:
+        params_format = DataclassStruct(params.__class__)
+
+    return params_format.build(params)
+
+
+payload_format = DataclassStruct(Payload)
 format = DataclassStruct(Timeguard)
@@ -1,28 +1,113 @@
 import argparse
+import asyncio
 import binascii
 from binascii import hexlify
-from copy import deepcopy
 from datetime import datetime
-from queue import Empty as QueueEmptyError, Queue
+from functools import lru_cache
+import logging
+from queue import Empty as QueueEmptyError, Full as QueueFullError, Queue
 import socket
-from time import sleep, time
-from typing import List, Optional, Tuple
+import threading
+from time import monotonic, perf_counter, sleep, time
+from typing import Callable, List, Optional, Tuple
 
-from arrow import Arrow
+from timeguard_mqtt import codec, crc, log, metrics, protocol, queues
+from timeguard_mqtt.receiver import BatchReceiver
+from timeguard_mqtt.registry import DeviceRegistry
+from timeguard_mqtt.retransmission import RetransmissionScheduler, SequenceAllocator
 
-from timeguard_mqtt import log, protocol
+MASKED_DEVICE_ID = 0x12345678
+
+
+class LazyStr:
+    # The string is built only when a log handler actually emits the record
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func: Callable[..., str], *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self) -> str:
+        try:
+            return self.func(*self.args)
+        except Exception as e:
+            return "<failed to prepare debug data: {!r}>".format(e)
+
+
+@lru_cache(maxsize=64)
+def mask_frame(data: bytes) -> Tuple[bytes, protocol.Timeguard]:
+    # Hiding the device id is not enough — it's relatively easy to restore it when you know the checksum, so the
+    # checksum is patched as well. The same frame is often printed a few times, hence the cache.
+    masked = codec.replace_device_id(data, MASKED_DEVICE_ID)
+    return masked, codec.parse(masked)
+
+
+def format_frame_bytes(data: bytes, mask: bool) -> str:
+    if mask:
+        data = mask_frame(data)[0]
+
+    return hexlify(data, " ", 1).decode("ascii")
+
+
+def format_frame(data: bytes, parsed_data: protocol.Timeguard, mask: bool) -> str:
+    return str(mask_frame(data)[1] if mask else parsed_data)
 
 
 class ProtocolHandler:
     CLOUDWARM_IP = "31.193.128.139"  # www.cloudwarm.net
 
-    def __init__(self, args, network_events_queue: Queue, mqtt_events_queue: Queue):
+    PING_RESPONSE_ID = protocol.Payload.get_message_type_id(
+        protocol.MessageType.PING,
+        protocol.MessageFlags.server(True) | protocol.MessageFlags.IS_SUCCESS,
+    )
+    CODE_VERSION_RESPONSE_ID = protocol.Payload.get_message_type_id(
+        protocol.MessageType.CODE_VERSION,
+        protocol.MessageFlags.server(True, False) | protocol.MessageFlags.IS_SUCCESS,
+    )
+
+    def __init__(
+        self,
+        args,
+        network_events_queue: Queue,
+        mqtt_events_queue: Queue,
+        device_registry=None,
+        device_store=None,
+    ):
         self.args = args
         self.network_events_queue = network_events_queue
         self.mqtt_events_queue = mqtt_events_queue
-        self.device_to_ip_map = dict()
+        if device_registry is None:
+            device_registry = DeviceRegistry(
+                args.device_online_timeout, args.max_devices
+            )
+        self.device_to_ip_map = device_registry
+        self.device_store = device_store
         self._stop = False
-        self._waiting_for_response = {}
+        self._sequences = SequenceAllocator(args.max_inflight_per_device)
+        self._waiting_for_response = RetransmissionScheduler(
+            args.resend_interval,
+            args.resend_timeout,
+            on_remove=lambda key: self._sequences.release(*key),
+        )
+        self._resend_timer: Optional[asyncio.TimerHandle] = None
+        self._resend_deadline = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+        self._socket: Optional[socket.socket] = None
+        # Compared with the source of every packet, so a host name is resolved once and for all
+        self.cloud_ip = ProtocolHandler.resolve_cloud_address(args.cloud_address)
+        self.cloud_port = args.cloud_port
+        self._templates = codec.FrameTemplates()
+        self._process_request = getattr(self, "process_request_{}".format(args.mode))
+
+    def resolve_cloud_address(address: str) -> str:
+        try:
+            return socket.gethostbyname(address)
+        except OSError as e:
+            raise Exception(
+                "Unable to resolve the cloud address: {}".format(address)
+            ) from e
 
     def prepare_argparse(parser: argparse._ActionsContainer):
         parser.add_argument(
@@ -46,31 +131,98 @@ class ProtocolHandler:
             help="Mask device ID and CRC32 in the debug output.",
             action="store_true",
         )
+        parser.add_argument(
+            "--cloud-address",
+            help="Address of the vendor's server, the devices' data is forwarded there. Defaults to "
+            + "{} (www.cloudwarm.net); a host name is resolved once, at the start.".format(
+                ProtocolHandler.CLOUDWARM_IP
+            ),
+            default=ProtocolHandler.CLOUDWARM_IP,
+        )
+        parser.add_argument(
+            "--cloud-port",
+            help="UDP port of the vendor's server.",
+            default=9997,
+            type=int,
+        )
+        parser.add_argument(
+            "--listen-address",
+            help="Address to receive the devices' traffic on.",
+            default="0.0.0.0",
+        )
+        parser.add_argument(
+            "--listen-port",
+            help="UDP port to receive the devices' traffic on.",
+            default=9997,
+            type=int,
+        )
+        parser.add_argument(
+            "--engine",
+            choices=["asyncio", "thread"],
+            help="Network engine. Asyncio — handle every datagram as soon as it arrives (default). Thread — the "
+            + "old polling loop, kept for compatibility.",
+            default="asyncio",
+        )
+        parser.add_argument(
+            "--receive-batch-size",
+            help="Maximum number of datagrams read from the socket in one go.",
+            default=32,
+            type=int,
+        )
+        parser.add_argument(
+            "--workers",
+            help="Number of protocol processes sharing the UDP port.",
+            default=1,
+            type=int,
+        )
+        parser.add_argument(
+            "--resend-interval",
+            help="Seconds to wait for the device to confirm a command before sending it again.",
+            default=2,
+            type=float,
+        )
+        parser.add_argument(
+            "--resend-timeout",
+            help="Seconds after which an unconfirmed command is dropped.",
+            default=15,
+            type=float,
+        )
+        parser.add_argument(
+            "--max-inflight-per-device",
+            help="Maximum number of unconfirmed commands per device.",
+            default=32,
+            type=int,
+        )
 
     def run(self):
         self._stop = False
-        self.relay()
+        if self.args.engine == "thread":
+            self.relay()
+        else:
+            asyncio.run(self.relay_async())
 
     def stop(self):
         self._stop = True
 
-    def print_bytes(
-        source_ip: str,
-        source_port: int,
-        destination_ip: Optional[str],
-        destination_port: Optional[int],
-        parsing_result: str,
-        data: bytes,
-    ):
-        log.debug(
-            "[{}:{} -> {}:{}] [parsing:{}] {}".format(
-                source_ip,
-                source_port,
-                destination_ip,
-                destination_port,
-                parsing_result,
-                hexlify(data, " ", 1).decode("ascii"),
-            )
+        if self._loop is not None and self._stopped is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._stopped.set)
+            except RuntimeError:
+                # The loop is already closed
+                pass
+
+    def get_parsing_result(parsed_data: Optional[protocol.Timeguard]) -> str:
+        if parsed_data is None:
+            return "failed"
+
+        if parsed_data.payload.message_type_id not in protocol.Payload.MESSAGE_TYPE_MAP:
+            return "unknown"
+
+        return "success"
+
+    def is_debug_enabled(self) -> bool:
+        return (self.args.debug or self.args.print_parsed_data) and log.isEnabledFor(
+            logging.DEBUG
         )
 
     def print_debug(
@@ -82,65 +234,60 @@ class ProtocolHandler:
         data: bytes,
         parsed_data: Optional[protocol.Timeguard],
     ):
-        if not self.args.debug and not self.args.print_parsed_data:
+        if not self.is_debug_enabled():
             return
 
-        parsing_result: str = "success"
-        if parsed_data is None:
-            parsing_result = "failed"
-        if isinstance(parsed_data.payload.params, bytes):
-            parsing_result = "unknown"
+        # The buffer the data was received into is going to be reused
+        data = bytes(data)
+        mask = self.args.mask and parsed_data is not None
 
-        try:
-            if self.args.debug or self.args.print_parsed_data:
-                debug_data = deepcopy(data)
-                if parsed_data:
-                    debug_obj = deepcopy(parsed_data)
-                    if self.args.mask:
-                        debug_obj.payload.device_id = 0x12345678
-
-                        # Hiding the device id is not enough — it's relatively easy to restore it when you know the
-                        # checksum.
-                        # The easiest way to replace the checksum and keep the packet valid is to build it and parse
-                        # again, `construct` would take care of the rest.
-                        debug_obj = protocol.format.parse(
-                            protocol.format.build(debug_obj)
-                        )
-                        debug_data = protocol.format.build(debug_obj)
-
-                if self.args.debug:
-                    ProtocolHandler.print_bytes(
-                        source_ip,
-                        source_port,
-                        destination_ip,
-                        destination_port,
-                        parsing_result,
-                        debug_data,
-                    )
+        if self.args.debug:
+            log.debug(
+                "[%s:%s -> %s:%s] [parsing:%s] %s",
+                source_ip,
+                source_port,
+                destination_ip,
+                destination_port,
+                ProtocolHandler.get_parsing_result(parsed_data),
+                LazyStr(format_frame_bytes, data, mask),
+            )
 
-                if self.args.print_parsed_data and debug_obj:
-                    log.debug(debug_obj)
-        except:
-            parsing_result = "failed_debug"
-            log.exception("Failed to prepare debug data")
+        if self.args.print_parsed_data and parsed_data is not None:
+            log.debug("%s", LazyStr(format_frame, data, parsed_data, mask))
 
     def relay_callback(
         self, source_ip: str, source_port: int, data: bytes
     ) -> List[Tuple[bool, bytes]]:
-        is_from_client = source_ip != self.CLOUDWARM_IP
+        started_at = perf_counter()
+        is_from_client = source_ip != self.cloud_ip
+        metrics.PACKETS_RECEIVED.inc(
+            "from_device" if is_from_client else "from_cloud",
+            codec.peek_message_type(data) or "invalid",
+        )
+
         parsed_data = None
-        try:
-            parsed_data = protocol.format.parse(data)
-        except:
-            log.exception("Failed to parse data: %s", binascii.hexlify(data))
+        if not crc.verify_frame(data):
+            # Corrupted frames are dropped before any decoding
+            log.warning("Invalid frame or checksum: %s", binascii.hexlify(data))
+        else:
+            try:
+                parsed_data = codec.parse(data, checksum_verified=True)
+            except:
+                log.exception("Failed to parse data: %s", binascii.hexlify(data))
+        metrics.PARSE_SECONDS.observe(perf_counter() - started_at)
+
+        parsing_result = ProtocolHandler.get_parsing_result(parsed_data)
+        if parsing_result != "success":
+            metrics.PARSE_FAILURES.inc(parsing_result)
 
         destination_ip, destination_port = None, None
         if parsed_data:
             if is_from_client:
-                if parsed_data.payload.seq in self._waiting_for_response:
-                    del self._waiting_for_response[parsed_data.payload.seq]
+                self._waiting_for_response.acknowledge(
+                    (parsed_data.payload.device_id, parsed_data.payload.seq)
+                )
 
-                destination_ip, destination_port = self.CLOUDWARM_IP, 9997
+                destination_ip, destination_port = self.cloud_ip, self.cloud_port
                 self.store_client(parsed_data.payload.device_id, source_ip, source_port)
             else:
                 destination_ip, destination_port = self.get_client(
@@ -161,19 +308,28 @@ class ProtocolHandler:
                 parsed_data,
             )
 
-        if destination_ip is None:
-            return []
+        ret = []
+        if destination_ip is not None:
+            if parsed_data:
+                self.queue_network_event(parsed_data)
 
-        if parsed_data:
-            self.network_events_queue.put(parsed_data)
+            # The received bytes are forwarded as-is, the parsed frame is used only for routing and events
+            ret = self._process_request(
+                destination_ip, destination_port, parsed_data, data
+            )
 
-        method = "process_request_{}".format(self.args.mode)
-        return getattr(self, method)(destination_ip, destination_port, parsed_data)
+        metrics.HANDLE_SECONDS.observe(perf_counter() - started_at, "protocol")
+
+        return ret
 
     def process_request_relay(
-        self, destination_ip: str, destination_port: int, data: protocol.Timeguard
+        self,
+        destination_ip: str,
+        destination_port: int,
+        data: protocol.Timeguard,
+        data_raw: bytes,
     ) -> List[Tuple[str, int, bytes]]:
-        return [(destination_ip, destination_port, protocol.format.build(data))]
+        return [(destination_ip, destination_port, data_raw)]
 
     def should_discard_server_query_in_fallback_mode(
         self, data: protocol.Timeguard
@@ -195,35 +351,45 @@ class ProtocolHandler:
         return False
 
     def process_request_fallback(
-        self, destination_ip: str, destination_port: int, data: protocol.Timeguard
+        self,
+        destination_ip: str,
+        destination_port: int,
+        data: protocol.Timeguard,
+        data_raw: bytes,
     ) -> List[Tuple[str, int, bytes]]:
-        ret = [(destination_ip, destination_port, protocol.format.build(data))]
+        ret = [(destination_ip, destination_port, data_raw)]
         if not data.is_from_server():
-            ret += self.process_request_local(destination_ip, destination_port, data)
+            ret += self.process_request_local(
+                destination_ip, destination_port, data, data_raw
+            )
         elif self.should_discard_server_query_in_fallback_mode(data):
             self.print_debug(
-                self.CLOUDWARM_IP,
-                9997,
+                self.cloud_ip,
+                self.cloud_port,
                 "void({})".format(destination_ip),
                 destination_port,
-                protocol.format.build(data),
+                data_raw,
                 data,
             )
             ret = []
         else:
             self.print_debug(
-                self.CLOUDWARM_IP,
-                9997,
+                self.cloud_ip,
+                self.cloud_port,
                 destination_ip,
                 destination_port,
-                protocol.format.build(data),
+                data_raw,
                 data,
             )
 
         return ret
 
     def process_request_local(
-        self, _destination_ip: str, _destination_port: int, data: protocol.Timeguard
+        self,
+        _destination_ip: str,
+        _destination_port: int,
+        data: protocol.Timeguard,
+        data_raw: bytes,
     ) -> List[Tuple[str, int, bytes]]:
         ret = []
 
@@ -237,71 +403,119 @@ class ProtocolHandler:
             and data.payload.message_flags & protocol.MessageFlags.IS_UPDATE_REQUEST
             == protocol.MessageFlags.IS_UPDATE_REQUEST
         ):
-            response = protocol.Timeguard.prepare(
-                protocol.MessageType.CODE_VERSION,
-                protocol.MessageFlags.server(True, False)
-                | protocol.MessageFlags.IS_SUCCESS,
-                data.payload.device_id,
-                payload_seq=0xFF,
-                code_version=data.payload.params.code_version,
+            params_raw = codec.build_params(
+                self.CODE_VERSION_RESPONSE_ID,
+                protocol.ReportCodeVersionResponse(
+                    code_version=data.payload.params.code_version
+                ),
             )
-            ret += [(destination_ip, destination_port, protocol.format.build(response))]
+            response = self.render(
+                self.CODE_VERSION_RESPONSE_ID, data.payload.device_id, params_raw
+            )
+            ret += [(destination_ip, destination_port, response)]
         elif data.payload.message_type == protocol.MessageType.PING:
-            response = protocol.Timeguard.prepare(
-                protocol.MessageType.PING,
-                protocol.MessageFlags.server(True) | protocol.MessageFlags.IS_SUCCESS,
+            response = self.render(
+                self.PING_RESPONSE_ID,
                 data.payload.device_id,
-                payload_seq=0xFF,
-                now=Arrow.now(),
+                codec.encode_timestamp(time()),
             )
-            ret += [(destination_ip, destination_port, protocol.format.build(response))]
+            ret += [(destination_ip, destination_port, response)]
         else:
             self.print_debug(
-                self.CLOUDWARM_IP,
-                9997,
+                self.cloud_ip,
+                self.cloud_port,
                 "void({})".format(destination_ip),
                 destination_port,
-                protocol.format.build(data),
+                data_raw,
                 data,
             )
 
-        for (device_ip, device_port, data_raw) in ret:
-            self.print_debug(
-                "internal",
-                9997,
-                device_ip,
-                device_port,
-                data_raw,
-                protocol.format.parse(data_raw),
-            )
+        if self.is_debug_enabled():
+            for device_ip, device_port, data_raw in ret:
+                self.print_debug(
+                    "internal",
+                    self.args.listen_port,
+                    device_ip,
+                    device_port,
+                    data_raw,
+                    codec.parse(data_raw),
+                )
 
         return ret
 
+    def build(self, data: protocol.Timeguard) -> bytes:
+        started_at = perf_counter()
+        data_raw = self._templates.build(data)
+        metrics.BUILD_SECONDS.observe(perf_counter() - started_at)
+
+        return data_raw
+
+    def render(self, message_type_id: int, device_id: int, params_raw: bytes) -> bytes:
+        # Responses which don't need a confirmation, straight from the template
+        started_at = perf_counter()
+        data_raw = self._templates.render(message_type_id, device_id, 0xFF, params_raw)
+        metrics.BUILD_SECONDS.observe(perf_counter() - started_at)
+
+        return data_raw
+
+    def count_sent(self, destination_ip: str, data: bytes):
+        metrics.PACKETS_SENT.inc(
+            "to_cloud" if destination_ip == self.cloud_ip else "to_device",
+            codec.peek_message_type(data) or "invalid",
+        )
+
+    def queue_network_event(self, data: protocol.Timeguard):
+        # Receiving must never wait for MQTT; NetworkEventsQueue makes the room itself, a bounded multiprocessing
+        # queue of the workers just drops the event
+        try:
+            self.network_events_queue.put_nowait(data)
+        except QueueFullError:
+            log.debug(
+                "Network events queue is full, dropping %s", data.payload.message_type
+            )
+
+    def watch_metrics(self):
+        metrics.watch_retransmissions(self._waiting_for_response)
+
     def store_client(self, device_id: int, ip: str, port: int):
-        if device_id not in self.device_to_ip_map:
-            self.device_to_ip_map[device_id] = ip, port
+        # Refreshed with every packet, the device might be behind a NAT which has changed its port
+        address = ip, port
+        changed = self.device_to_ip_map.get(device_id) != address
+        self.device_to_ip_map[device_id] = address
+        if changed and self.device_store is not None:
+            self.device_store.save_address(device_id, address)
 
     def get_client(self, device_id) -> Tuple[Optional[str], Optional[int]]:
-        return self.device_to_ip_map.get(device_id, (None, None))
+        address = self.device_to_ip_map.get(device_id)
+        if address is None and self.device_store is not None:
+            # The device might have been seen before the restart. It's registered again only once it's heard from,
+            # an evicted or a long gone device mustn't be revived by the packets for it.
+            address = self.device_store.get_address(device_id)
+
+        return address or (None, None)
 
     def add_command_to_waiting_list(
         self, data: protocol.Timeguard
-    ) -> protocol.Timeguard:
-        if 0 <= data.payload.seq < 0xFF:
-            if len(self._waiting_for_response) >= 0xFE:
-                log.error("Too many messages are waiting for confirmation")
-                return []
+    ) -> Optional[protocol.Timeguard]:
+        if not 0 <= data.payload.seq < 0xFF:
+            return data
+
+        device_id = data.payload.device_id
+        stored = self._waiting_for_response.get((device_id, data.payload.seq))
+        if stored is not None and stored.data == data:
+            # The very same command is being waited for already, just restart its timer
+            self._waiting_for_response.add((device_id, data.payload.seq), data)
+            return data
+
+        seq = self._sequences.allocate(device_id)
+        if seq is None:
+            log.error(
+                "Too many messages are waiting for confirmation from %08x", device_id
+            )
+            return None
 
-            if data.payload.seq in self._waiting_for_response:
-                stored_data = self._waiting_for_response[data.payload.seq]
-                if stored_data != data:
-                    while data.payload.seq in self._waiting_for_response:
-                        data.payload.seq = (data.payload.seq + 1) % 255
-            self._waiting_for_response[data.payload.seq] = {
-                "queue_time": time(),
-                "resend_after": time() + 2,
-                "data": data,
-            }
+        data.payload.seq = seq
+        self._waiting_for_response.add((device_id, seq), data)
 
         return data
 
@@ -315,18 +529,154 @@ class ProtocolHandler:
 
         if not resending:
             data = self.add_command_to_waiting_list(data)
+            if data is None:
+                return []
 
-        data_raw = protocol.format.build(data)
-        self.print_debug("internal", 9997, device_ip, device_port, data_raw, data)
+        data_raw = self.build(data)
+        self.print_debug(
+            "internal", self.args.listen_port, device_ip, device_port, data_raw, data
+        )
 
         return [(device_ip, device_port, data_raw)]
 
-    def relay(self):
+    def create_socket(self) -> socket.socket:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.setblocking(False)
-        sock.bind(("0.0.0.0", 9997))
+        sock.bind((self.args.listen_address, self.args.listen_port))
+
+        return sock
+
+    async def relay_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if self._stop:
+            return
+
+        self._socket = self.create_socket()
+        receiver = BatchReceiver(self.args.receive_batch_size)
+        # Readiness callback rather than a DatagramProtocol: the latter gets a freshly allocated `bytes` per datagram,
+        # while here the whole backlog is drained into reusable buffers in one go
+        self._loop.add_reader(
+            self._socket.fileno(), self.socket_readable, self._socket, receiver
+        )
+        mqtt_events_task = asyncio.create_task(
+            self.process_mqtt_events(*self.bridge_mqtt_events())
+        )
+
+        try:
+            await self._stopped.wait()
+        finally:
+            mqtt_events_task.cancel()
+            if isinstance(self.mqtt_events_queue, queues.CommandsQueue):
+                self.mqtt_events_queue.unbridge()
+            self._loop.remove_reader(self._socket.fileno())
+            self._socket.close()
+
+    def bridge_mqtt_events(self) -> Tuple[asyncio.Queue, Callable[[], None]]:
+        # The MQTT thread hands the commands over to the loop itself; the ones coming from another process are
+        # forwarded by a thread of their own
+        if isinstance(self.mqtt_events_queue, queues.CommandsQueue):
+            return (
+                self.mqtt_events_queue.bridge(self._loop),
+                self.mqtt_events_queue.taken,
+            )
+
+        events = asyncio.Queue()
+        threading.Thread(
+            target=self.forward_mqtt_events,
+            args=(self._loop, events),
+            name="mqtt-events",
+            daemon=True,
+        ).start()
+
+        return events, lambda: None
+
+    def forward_mqtt_events(
+        self, loop: asyncio.AbstractEventLoop, events: asyncio.Queue
+    ):
+        while not self._stop:
+            try:
+                tg_data = self.mqtt_events_queue.get(timeout=0.5)
+            except QueueEmptyError:
+                continue
+
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, tg_data)
+            except RuntimeError:
+                # The loop is already closed
+                return
+
+    async def process_mqtt_events(
+        self, events: asyncio.Queue, taken: Callable[[], None]
+    ):
+        while True:
+            tg_data = await events.get()
+            taken()
+
+            try:
+                self.send(self.build_requests_from_protocol(tg_data))
+            except Exception:
+                log.exception("Error while processing a message from MQTT")
+
+            self.schedule_resends()
+
+    def schedule_resends(self):
+        # A single timer is armed for the earliest deadline
+        deadline = self._waiting_for_response.next_deadline()
+        if deadline is None:
+            return
+
+        if self._resend_timer is not None:
+            if self._resend_deadline <= deadline:
+                return
+            self._resend_timer.cancel()
+
+        self._resend_deadline = deadline
+        self._resend_timer = self._loop.call_later(
+            max(0, deadline - monotonic()), self.process_resends
+        )
+
+    def process_resends(self):
+        self._resend_timer = None
+        self.send(self.get_resend_requests())
+        self.schedule_resends()
+
+    def get_resend_requests(self) -> List[Tuple[str, int, bytes]]:
+        ret = []
+        try:
+            for pending in self._waiting_for_response.pop_due():
+                ret += self.build_requests_from_protocol(pending.data, True)
+        except:
+            log.exception("Failed to process resending queue")
+
+        return ret
+
+    def socket_readable(self, sock: socket.socket, receiver: BatchReceiver):
+        try:
+            datagrams = receiver.drain(sock)
+        except Exception:
+            log.exception("Error while receiving data from UDP")
+            return
+
+        for data, fromaddr in datagrams:
+            try:
+                self.send(self.relay_callback(fromaddr[0], fromaddr[1], data))
+            except Exception:
+                log.exception("Error while processing a message from UDP")
+
+    def send(self, rewritten_data: List[Tuple[str, int, bytes]]):
+        for destination_ip, destination_port, data in rewritten_data:
+            try:
+                self._socket.sendto(data, (destination_ip, destination_port))
+                self.count_sent(destination_ip, data)
+            except:
+                log.exception("Failed to send the data")
+
+    def relay(self):
+        sock = self.create_socket()
+        receiver = BatchReceiver(self.args.receive_batch_size)
 
         while True:
             if self._stop:
@@ -342,37 +692,25 @@ class ProtocolHandler:
                 log.exception("Error while processing a message from MQTT")
 
             try:
-                data, fromaddr = sock.recvfrom(1024)
-                rewritten_data += self.relay_callback(fromaddr[0], fromaddr[1], data)
-            except BlockingIOError:
-                pass
+                datagrams = receiver.drain(sock)
             except Exception:
-                log.exception("Error while processing a message from UDP")
+                datagrams = []
+                log.exception("Error while receiving data from UDP")
 
-            try:
-                messages_to_remove = []
-                for seq, waiting_config in self._waiting_for_response.items():
-                    if (
-                        waiting_config["resend_after"] - waiting_config["queue_time"]
-                        >= 15
-                    ):
-                        messages_to_remove.append(seq)
-                        continue
-
-                    if waiting_config["resend_after"] <= time():
-                        rewritten_data += self.build_requests_from_protocol(
-                            waiting_config["data"], True
-                        )
-                        self._waiting_for_response[seq]["resend_after"] = time() + 2
-
-                for seq in messages_to_remove:
-                    del self._waiting_for_response[seq]
-            except:
-                log.exception("Failed to process resending queue")
+            for data, fromaddr in datagrams:
+                try:
+                    rewritten_data += self.relay_callback(
+                        fromaddr[0], fromaddr[1], data
+                    )
+                except Exception:
+                    log.exception("Error while processing a message from UDP")
+
+            rewritten_data += self.get_resend_requests()
 
-            for (destination_ip, destination_port, data) in rewritten_data:
+            for destination_ip, destination_port, data in rewritten_data:
                 try:
                     sock.sendto(data, (destination_ip, destination_port))
+                    self.count_sent(destination_ip, data)
                 except:
                     log.exception("Failed to send the data")
 
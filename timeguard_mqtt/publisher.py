@@ -0,0 +1,106 @@
+import threading
+from time import monotonic
+import typing
+
+from timeguard_mqtt import metrics
+
+PublishCallback = typing.Callable[[str, typing.Any, int, bool], None]
+
+
+class PublishCoalescer:
+    # Outbound MQTT publishes are held for `window` seconds. A newer value for a topic which is still pending replaces
+    # the old one and keeps its place in the line, so the latest values are flushed in the order the topics were
+    # first touched. Flushing is limited by a global publishes-per-second budget (a token bucket holding up to a
+    # second worth of publishes, and at least one so that rates below one per second still get through). With no
+    # window and no limit the publishes go straight through. While paused (e.g. the broker is unreachable) nothing is
+    # flushed, so the backlog is limited to one publish per topic.
+
+    def __init__(
+        self,
+        publish: PublishCallback,
+        window: float = 0,
+        rate_limit: float = 0,
+        clock: typing.Callable[[], float] = monotonic,
+    ):
+        self._publish = publish
+        self.window = window
+        self.rate_limit = rate_limit
+        self.clock = clock
+        self._pending: typing.Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._capacity = max(1.0, rate_limit)
+        self._tokens = self._capacity
+        self._refilled_at = clock()
+        self.paused = False
+
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.flush()
+
+    def put(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        if (
+            self.window <= 0
+            and self.rate_limit <= 0
+            and not self.paused
+            and not self._pending
+        ):
+            self._publish(topic, payload, qos, retain)
+            return
+
+        now = self.clock()
+        with self._lock:
+            pending = self._pending.get(topic)
+            if pending is None:
+                self._pending[topic] = [now + self.window, payload, qos, retain]
+            else:
+                pending[1:] = payload, max(qos, pending[2]), retain
+                self.coalesced += 1
+                metrics.MQTT_PUBLISHES_COALESCED.inc()
+
+        if self.window <= 0 and not self.paused:
+            self.flush(now)
+
+    def flush(self, now: typing.Optional[float] = None, force: bool = False) -> int:
+        if now is None:
+            now = self.clock()
+
+        if self.paused and not force:
+            return 0
+
+        due = []
+        with self._lock:
+            if self.rate_limit > 0:
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._refilled_at) * self.rate_limit,
+                )
+                self._refilled_at = now
+
+            # The window is the same for every topic, so the line is ordered by the deadlines as well
+            while self._pending:
+                topic = next(iter(self._pending))
+                pending = self._pending[topic]
+                if not force:
+                    if pending[0] > now:
+                        break
+
+                    if self.rate_limit > 0:
+                        if self._tokens < 1:
+                            break
+                        self._tokens -= 1
+
+                del self._pending[topic]
+                due.append((topic, pending))
+
+        for topic, (_, payload, qos, retain) in due:
+            self._publish(topic, payload, qos, retain)
+
+        return len(due)
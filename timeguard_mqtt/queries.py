@@ -0,0 +1,66 @@
+from time import monotonic
+import typing
+
+from timeguard_mqtt import protocol
+
+QueryKey = typing.Tuple[protocol.MessageType, typing.Optional[int]]
+
+
+class QueryTracker:
+    # Queries sent to the devices and not answered yet, by the device and (message type, schedule id). A query isn't
+    # sent again until its backoff runs out; the backoff doubles with every unanswered attempt, up to max_backoff.
+
+    def __init__(
+        self,
+        backoff: float = 10,
+        max_backoff: float = 300,
+        clock: typing.Callable[[], float] = monotonic,
+    ):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        # Per device: the time a query may be repeated at and the number of attempts already made
+        self._pending: typing.Dict[
+            int, typing.Dict[QueryKey, typing.Tuple[float, int]]
+        ] = {}
+
+    def __len__(self) -> int:
+        return sum(len(queries) for queries in self._pending.values())
+
+    def should_send(
+        self,
+        device_id: int,
+        message_type: protocol.MessageType,
+        schedule_id: typing.Optional[int] = None,
+    ) -> bool:
+        now = self.clock()
+        queries = self._pending.setdefault(device_id, {})
+        key = (message_type, schedule_id)
+
+        attempts = 0
+        if (pending := queries.get(key)) is not None:
+            retry_at, attempts = pending
+            if now < retry_at:
+                return False
+
+            attempts += 1
+
+        queries[key] = (
+            now + min(self.backoff * 2**attempts, self.max_backoff),
+            attempts,
+        )
+
+        return True
+
+    def answered(
+        self,
+        device_id: int,
+        message_type: protocol.MessageType,
+        schedule_id: typing.Optional[int] = None,
+    ):
+        queries = self._pending.get(device_id)
+        if queries is not None:
+            queries.pop((message_type, schedule_id), None)
+
+    def forget(self, device_id: int):
+        self._pending.pop(device_id, None)
@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+from collections import OrderedDict, deque
+from queue import Empty as QueueEmptyError, Full as QueueFullError, Queue
+import threading
+from time import monotonic
+import typing
+
+from timeguard_mqtt import protocol
+
+
+def telemetry_key(data: protocol.Timeguard) -> typing.Optional[typing.Hashable]:
+    # Pings only report the current state of a device, the latest one makes the previous ones useless
+    payload = data.payload
+    if payload.message_type != protocol.MessageType.PING:
+        return None
+
+    return payload.device_id, bool(
+        payload.message_flags & protocol.MessageFlags.IS_FROM_SERVER
+    )
+
+
+class NetworkEventsQueue:
+    # Parsed packets on their way from the protocol handler to MQTT. The producer never waits: a ping replaces the
+    # one still waiting for the same device, in its place in the line. When the queue is full the oldest waiting ping
+    # is dropped to make room, and if there are none, the new packet is dropped. Dropped pings stay in the line as
+    # empty slots until they're skipped or compacted away.
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        key: typing.Callable[
+            [typing.Any], typing.Optional[typing.Hashable]
+        ] = telemetry_key,
+    ):
+        self.maxsize = maxsize
+        self.key = key
+        # Slots of [item, key], the item is None once the slot is dropped
+        self._items: typing.Deque[list] = deque()
+        self._telemetry: typing.OrderedDict[typing.Hashable, list] = OrderedDict()
+        self._size = 0
+        self._not_empty = threading.Condition()
+
+        self.overflows = 0
+        self.coalesced = 0
+        self.high_water = 0
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def put(self, item, block: bool = True, timeout: typing.Optional[float] = None):
+        key = self.key(item)
+        with self._not_empty:
+            if key is not None:
+                slot = self._telemetry.get(key)
+                if slot is not None:
+                    slot[0] = item
+                    self.coalesced += 1
+                    return
+
+            if self.maxsize > 0 and self._size >= self.maxsize:
+                self.overflows += 1
+                if not self._telemetry:
+                    return
+
+                _, dropped = self._telemetry.popitem(last=False)
+                dropped[0] = None
+                self._size -= 1
+                if len(self._items) > 2 * self.maxsize:
+                    self._items = deque(
+                        slot for slot in self._items if slot[0] is not None
+                    )
+
+            slot = [item, key]
+            self._items.append(slot)
+            if key is not None:
+                self._telemetry[key] = slot
+
+            self._size += 1
+            if self._size > self.high_water:
+                self.high_water = self._size
+
+            self._not_empty.notify()
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def get(self, block: bool = True, timeout: typing.Optional[float] = None):
+        with self._not_empty:
+            if not self._size:
+                if not block:
+                    raise QueueEmptyError
+
+                deadline = None if timeout is None else monotonic() + timeout
+                while not self._size:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise QueueEmptyError
+
+                    self._not_empty.wait(remaining)
+
+            while True:
+                item, key = self._items.popleft()
+                if item is not None:
+                    break
+
+            self._size -= 1
+            if key is not None:
+                del self._telemetry[key]
+
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+
+class CommandsQueue(Queue):
+    # Commands for the devices. `maxsize` only bounds what's added without waiting — the queries MQTT sends on its
+    # own, which are asked again later anyway; a full queue makes `put_nowait` raise. The commands the users send are
+    # always accepted and never waited for, they come at a human rate. Either way the time the queue was found full is
+    # counted. Once it's bridged to an asyncio loop, the commands are handed over to the loop as soon as they're added;
+    # they still take up room in the queue until the loop reports them taken.
+
+    def _init(self, maxsize: int):
+        super()._init(maxsize)
+        self.overflows = 0
+        self.high_water = 0
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._bridged: typing.Optional[asyncio.Queue] = None
+        self._handed_over = 0
+
+    def put(self, item, block: bool = True, timeout: typing.Optional[float] = None):
+        with self.mutex:
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                self.overflows += 1
+                if not block:
+                    raise QueueFullError
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def bridge(self, loop: asyncio.AbstractEventLoop) -> asyncio.Queue:
+        # Has to be called from the loop, the commands already waiting are handed over first
+        with self.mutex:
+            self._loop = loop
+            self._bridged = asyncio.Queue()
+
+        self._hand_over(self._bridged)
+        return self._bridged
+
+    def unbridge(self):
+        # Has to be called from the loop, the commands it hasn't taken go back to the queue
+        with self.mutex:
+            waiting = self.queue
+            self.queue = deque()
+            while not self._bridged.empty():
+                self.queue.append(self._bridged.get_nowait())
+            self.queue.extend(waiting)
+
+            self._loop = None
+            self._bridged = None
+            self._handed_over = 0
+
+    def taken(self):
+        with self.mutex:
+            self._handed_over -= 1
+            self.not_full.notify()
+
+    def _qsize(self) -> int:
+        return len(self.queue) + self._handed_over
+
+    def _hand_over(self, bridged: asyncio.Queue):
+        with self.mutex:
+            if bridged is not self._bridged:
+                return
+
+            while self.queue:
+                bridged.put_nowait(self.queue.popleft())
+                self._handed_over += 1
+
+    def _put(self, item):
+        super()._put(item)
+        if self._loop is not None and len(self.queue) == 1:
+            self._loop.call_soon_threadsafe(self._hand_over, self._bridged)
+
+        if self._qsize() > self.high_water:
+            self.high_water = self._qsize()
+
+
+def prepare_argparse(parser: argparse._ActionsContainer):
+    parser.add_argument(
+        "--network-queue-size",
+        help="Maximum number of received packets waiting to be handled by MQTT, 0 for no limit. "
+        + "Pings replace the older ones of the same device, when the queue is full the oldest pings are dropped.",
+        default=10000,
+        type=int,
+    )
+    parser.add_argument(
+        "--commands-queue-size",
+        help="Maximum number of commands waiting to be sent to the devices, 0 for no limit. "
+        + "When the queue is full the queries are dropped, the commands are still accepted.",
+        default=1000,
+        type=int,
+    )
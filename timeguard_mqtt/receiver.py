@@ -0,0 +1,32 @@
+import socket
+from typing import List, Tuple
+
+
+class BatchReceiver:
+    # Drains a non-blocking UDP socket into a ring of preallocated buffers. The returned memoryviews point into the
+    # ring, so they stay valid only until the buffer is reused by one of the following `drain` calls.
+
+    def __init__(self, batch_size: int = 32, buffer_size: int = 1024, batches: int = 2):
+        self.batch_size = batch_size
+        self._buffers = [bytearray(buffer_size) for _ in range(batch_size * batches)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+        self._position = 0
+
+    def drain(self, sock: socket.socket) -> List[Tuple[memoryview, Tuple[str, int]]]:
+        ret = []
+        views = self._views
+        position = self._position
+
+        for _ in range(self.batch_size):
+            view = views[position]
+            try:
+                size, address = sock.recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
+
+            ret.append((view[:size], address))
+            position = (position + 1) % len(views)
+
+        self._position = position
+
+        return ret
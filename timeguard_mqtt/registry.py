@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from time import monotonic
+import typing
+
+
+class DeviceEntry:
+    __slots__ = ("value", "seen_at")
+
+    def __init__(self, value, seen_at: float):
+        self.value = value
+        self.seen_at = seen_at
+
+
+class DeviceRegistry:
+    # Values by the device id, ordered by the time the device was last seen. Devices not seen for `ttl` seconds are
+    # dropped, and so are the least recently seen ones once there are more than `max_size` of them. Both checks start
+    # from the oldest entry, so they cost nothing until there's something to drop. 0 disables either limit.
+
+    def __init__(
+        self,
+        ttl: float = 0,
+        max_size: int = 0,
+        clock: typing.Callable[[], float] = monotonic,
+        on_evict: typing.Optional[typing.Callable[[int, typing.Any], None]] = None,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.on_evict = on_evict
+        self._entries: typing.OrderedDict[int, DeviceEntry] = OrderedDict()
+
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, device_id: int) -> bool:
+        return device_id in self._entries
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(list(self._entries))
+
+    def keys(self) -> typing.List[int]:
+        return list(self._entries)
+
+    def __getitem__(self, device_id: int):
+        return self._entries[device_id].value
+
+    def get(self, device_id: int, default=None):
+        entry = self._entries.get(device_id)
+        return default if entry is None else entry.value
+
+    def __setitem__(self, device_id: int, value):
+        now = self.clock()
+        entry = self._entries.get(device_id)
+        if entry is None:
+            self._entries[device_id] = DeviceEntry(value, now)
+        else:
+            entry.value = value
+            entry.seen_at = now
+            self._entries.move_to_end(device_id)
+
+        self.expire(now)
+
+    def touch(self, device_id: int):
+        # The device has been seen, its value stays the same
+        entry = self._entries.get(device_id)
+        if entry is None:
+            return
+
+        now = self.clock()
+        entry.seen_at = now
+        self._entries.move_to_end(device_id)
+        self.expire(now)
+
+    def pop(self, device_id: int, default=None):
+        entry = self._entries.pop(device_id, None)
+        return default if entry is None else entry.value
+
+    def expire(self, now: typing.Optional[float] = None):
+        entries = self._entries
+        if not entries:
+            return
+
+        if now is None:
+            now = self.clock()
+
+        while entries:
+            device_id, entry = next(iter(entries.items()))
+            if not (self.max_size and len(entries) > self.max_size) and not (
+                self.ttl and now - entry.seen_at > self.ttl
+            ):
+                break
+
+            del entries[device_id]
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(device_id, entry.value)
@@ -0,0 +1,162 @@
+from collections import deque
+import heapq
+from itertools import count
+from time import monotonic
+import typing
+
+from timeguard_mqtt import protocol
+
+
+class PendingCommand:
+    __slots__ = ("key", "data", "queued_at", "resend_after")
+
+    def __init__(
+        self,
+        key: typing.Hashable,
+        data: protocol.Timeguard,
+        queued_at: float,
+        resend_after: float,
+    ):
+        self.key = key
+        self.data = data
+        self.queued_at = queued_at
+        self.resend_after = resend_after
+
+
+class RetransmissionScheduler:
+    # Commands waiting for the device's confirmation, ordered by their next deadline in a min-heap. Confirmed commands
+    # are removed from the index straight away and their heap entries are skipped once they reach the top.
+
+    def __init__(
+        self,
+        resend_interval: float = 2,
+        give_up_after: float = 15,
+        clock: typing.Callable[[], float] = monotonic,
+        on_remove: typing.Optional[typing.Callable[[typing.Hashable], None]] = None,
+    ):
+        self.resend_interval = resend_interval
+        self.give_up_after = give_up_after
+        self.clock = clock
+        self.on_remove = on_remove
+        self._pending: typing.Dict[typing.Hashable, PendingCommand] = {}
+        self._heap: typing.List[typing.Tuple[float, int, PendingCommand]] = []
+        self._counter = count()
+
+        self.resends = 0
+        self.expiries = 0
+        self.acknowledgements = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        return key in self._pending
+
+    def get(self, key: typing.Hashable) -> typing.Optional[PendingCommand]:
+        return self._pending.get(key)
+
+    def add(self, key: typing.Hashable, data: protocol.Timeguard) -> PendingCommand:
+        now = self.clock()
+        pending = PendingCommand(key, data, now, now + self.resend_interval)
+        self._pending[key] = pending
+        self._push(pending)
+
+        return pending
+
+    def acknowledge(self, key: typing.Hashable) -> bool:
+        if self._pending.pop(key, None) is None:
+            return False
+
+        self.acknowledgements += 1
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+        return True
+
+    def next_deadline(self) -> typing.Optional[float]:
+        heap = self._heap
+        while heap and not self._is_current(heap[0]):
+            heapq.heappop(heap)
+
+        return heap[0][0] if heap else None
+
+    def pop_due(
+        self, now: typing.Optional[float] = None
+    ) -> typing.List[PendingCommand]:
+        if now is None:
+            now = self.clock()
+
+        ret = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if not self._is_current(entry):
+                continue
+
+            pending = entry[2]
+            if now - pending.queued_at >= self.give_up_after:
+                del self._pending[pending.key]
+                self.expiries += 1
+                if self.on_remove is not None:
+                    self.on_remove(pending.key)
+                continue
+
+            pending.resend_after = now + self.resend_interval
+            self._push(pending)
+            self.resends += 1
+            ret.append(pending)
+
+        return ret
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "resends": self.resends,
+            "expiries": self.expiries,
+            "acknowledgements": self.acknowledgements,
+        }
+
+    def _push(self, pending: PendingCommand):
+        heapq.heappush(self._heap, (pending.resend_after, next(self._counter), pending))
+
+    def _is_current(self, entry: typing.Tuple[float, int, PendingCommand]) -> bool:
+        pending = entry[2]
+        return (
+            self._pending.get(pending.key) is pending
+            and pending.resend_after == entry[0]
+        )
+
+
+class SequenceAllocator:
+    # Every device has its own space of sequence numbers, 0xFF is reserved for messages which don't need a
+    # confirmation. Free numbers are handed out in FIFO order, so a number isn't reused right after it was released.
+
+    SEQ_COUNT = 0xFF
+
+    def __init__(self, max_inflight_per_device: int = 32):
+        self.max_inflight_per_device = min(max_inflight_per_device, self.SEQ_COUNT)
+        self._free: typing.Dict[int, typing.Deque[int]] = {}
+
+    def inflight(self, device_id: int) -> int:
+        free = self._free.get(device_id)
+        return self.SEQ_COUNT - len(free) if free is not None else 0
+
+    def allocate(self, device_id: int) -> typing.Optional[int]:
+        free = self._free.get(device_id)
+        if free is None:
+            free = self._free[device_id] = deque(range(self.SEQ_COUNT))
+
+        if self.SEQ_COUNT - len(free) >= self.max_inflight_per_device:
+            return None
+
+        return free.popleft()
+
+    def release(self, device_id: int, seq: int):
+        free = self._free.get(device_id)
+        if free is None:
+            return
+
+        free.append(seq)
+        if len(free) == self.SEQ_COUNT:
+            # Nothing is in flight for the device anymore
+            del self._free[device_id]
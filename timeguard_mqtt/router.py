@@ -0,0 +1,54 @@
+import typing
+
+WILDCARD = "+"
+
+
+class _Node:
+    __slots__ = ("children", "handler")
+
+    def __init__(self):
+        self.children: typing.Dict[str, "_Node"] = {}
+        self.handler: typing.Optional[typing.Callable] = None
+
+
+class TopicRouter:
+    # Routes are kept as a tree of topic levels, "+" matches any single level. A topic is walked level by level, so an
+    # unknown one is usually rejected at its first level; the values of the matched wildcards are given back in order.
+
+    def __init__(self):
+        self._root = _Node()
+
+    def add(self, topic: str, handler: typing.Callable):
+        node = self._root
+        for level in topic.split("/"):
+            node = node.children.setdefault(level, _Node())
+
+        node.handler = handler
+
+    def match(
+        self, topic: str
+    ) -> typing.Optional[typing.Tuple[typing.Callable, typing.List[str]]]:
+        return self._match(self._root, topic.split("/"), 0, [])
+
+    def _match(
+        self,
+        node: _Node,
+        levels: typing.List[str],
+        index: int,
+        params: typing.List[str],
+    ) -> typing.Optional[typing.Tuple[typing.Callable, typing.List[str]]]:
+        if index == len(levels):
+            return None if node.handler is None else (node.handler, params)
+
+        level = levels[index]
+        child = node.children.get(level)
+        if child is not None:
+            ret = self._match(child, levels, index + 1, params)
+            if ret is not None:
+                return ret
+
+        child = node.children.get(WILDCARD)
+        if child is not None:
+            return self._match(child, levels, index + 1, params + [level])
+
+        return None
@@ -0,0 +1,496 @@
+import argparse
+import dataclasses
+import heapq
+import json
+import logging
+from queue import Empty as QueueEmptyError, Queue
+from random import Random
+import select
+import socket
+import sys
+import threading
+from time import perf_counter, sleep
+import typing
+
+from arrow import Arrow
+
+from timeguard_mqtt import codec, log, protocol, queues
+from timeguard_mqtt.bench import StubMqttClient, sample_params
+from timeguard_mqtt.mqtt import Mqtt
+from timeguard_mqtt.protocol_handler import ProtocolHandler
+from timeguard_mqtt.receiver import BatchReceiver
+
+# Every server request has its response 7 flags "below" it, e.g. GET_SCHEDULE (197) -> GET_SCHEDULE_RESPONSE (85)
+RESPONSE_TYPE_ID_OFFSET = 0x70
+
+# How many sent messages per device are remembered to match them with the cloud and MQTT sides
+SENT_HISTORY_SIZE = 64
+
+
+def percentile(values: typing.List[float], percent: float) -> typing.Optional[float]:
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+class Latencies:
+    def __init__(self):
+        self._values: typing.Dict[str, typing.List[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self._values.setdefault(name, []).append(seconds)
+
+    def summary(self) -> typing.Dict[str, dict]:
+        with self._lock:
+            values = {name: list(latencies) for name, latencies in self._values.items()}
+
+        return {
+            name: {
+                "count": len(latencies),
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies),
+            }
+            for name, latencies in values.items()
+        }
+
+
+class VirtualDevice:
+    __slots__ = (
+        "device_id",
+        "sock",
+        "message_id",
+        "uptime_started_at",
+        "active_schedule_id",
+        "last_ping_sent_at",
+    )
+
+    def __init__(self, device_id: int, sock: socket.socket):
+        self.device_id = device_id
+        self.sock = sock
+        self.message_id = 0x100
+        self.uptime_started_at = perf_counter()
+        self.active_schedule_id = 0
+        self.last_ping_sent_at: typing.Optional[float] = None
+
+
+class VirtualFleet:
+    # A bunch of virtual time-switches. Devices share the sockets, the handler tells them apart by the device id and
+    # answers to the address the device was last seen from, so a single socket can serve many devices.
+
+    def __init__(
+        self,
+        size: int,
+        handler_address: typing.Tuple[str, int],
+        latencies: Latencies,
+        ping_interval: float = 10,
+        devices_per_socket: int = 64,
+        seed: int = 0,
+    ):
+        self.handler_address = handler_address
+        self.latencies = latencies
+        self.ping_interval = ping_interval
+        self.sent_at: typing.Dict[typing.Tuple[int, int], float] = {}
+        self.received = 0
+        self.sent = 0
+        self._random = Random(seed)
+        self._receiver = BatchReceiver()
+        self._sockets: typing.List[socket.socket] = []
+        self.devices: typing.Dict[int, VirtualDevice] = {}
+
+        for index in range(size):
+            if index % devices_per_socket == 0:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+                sock.setblocking(False)
+                sock.bind((handler_address[0], 0))
+                self._sockets.append(sock)
+
+            device_id = 0x10000000 + index
+            self.devices[device_id] = VirtualDevice(device_id, self._sockets[-1])
+
+    def close(self):
+        for sock in self._sockets:
+            sock.close()
+
+    def send(
+        self,
+        device: VirtualDevice,
+        message_type: protocol.MessageType,
+        message_flags: protocol.MessageFlags,
+        payload_seq: int = 0xFF,
+        **params,
+    ):
+        device.message_id = (device.message_id + 1) & 0xFFFFFFFF
+        data = protocol.Timeguard.prepare(
+            message_type,
+            message_flags,
+            device.device_id,
+            message_id=device.message_id,
+            payload_seq=payload_seq,
+            **params,
+        )
+        data_raw = codec.build(data)
+
+        now = perf_counter()
+        self.sent_at[(device.device_id, device.message_id)] = now
+        self.sent_at.pop(
+            (device.device_id, device.message_id - SENT_HISTORY_SIZE), None
+        )
+        if message_type == protocol.MessageType.PING:
+            device.last_ping_sent_at = now
+
+        try:
+            device.sock.sendto(data_raw, self.handler_address)
+            self.sent += 1
+        except OSError:
+            log.exception("Failed to send the data")
+
+    def send_code_version(self, device: VirtualDevice):
+        self.send(
+            device,
+            protocol.MessageType.CODE_VERSION,
+            protocol.MessageFlags(
+                protocol.MessageFlags.IS_UPDATE_REQUEST | protocol.MessageFlags.UNKNOWN1
+            ),
+            **sample_params(protocol.ReportCodeVersionRequest),
+        )
+
+    def send_ping(self, device: VirtualDevice):
+        params = sample_params(protocol.PingRequest)
+        params["uptime"] = int(perf_counter() - device.uptime_started_at)
+        self.send(
+            device,
+            protocol.MessageType.PING,
+            protocol.MessageFlags(
+                protocol.MessageFlags.IS_UPDATE_REQUEST | protocol.MessageFlags.UNKNOWN1
+            ),
+            **params,
+        )
+
+    def respond(self, device: VirtualDevice, request: protocol.Timeguard):
+        response_type_id = request.payload.message_type_id - RESPONSE_TYPE_ID_OFFSET
+        response_class = protocol.Payload.MESSAGE_TYPE_MAP.get(response_type_id)
+        if response_class is None:
+            return
+
+        # The device confirms what it was asked to set, or reports the values it was asked about
+        params = sample_params(response_class)
+        for field in dataclasses.fields(response_class):
+            if field.init and hasattr(request.payload.params, field.name):
+                params[field.name] = getattr(request.payload.params, field.name)
+
+        if response_class is protocol.GetCurrentScheduleResponse:
+            params["schedule_id"] = device.active_schedule_id
+        elif response_class is protocol.SetCurrentScheduleResponse:
+            device.active_schedule_id = params["schedule_id"]
+
+        self.send(
+            device,
+            protocol.MessageType(response_type_id & 0x0F),
+            protocol.MessageFlags(response_type_id >> 4),
+            payload_seq=request.payload.seq,
+            **params,
+        )
+
+    def handle(self, data: protocol.Timeguard):
+        device = self.devices.get(data.payload.device_id)
+        if device is None or not data.is_from_server():
+            return
+
+        self.received += 1
+        if data.payload.message_type == protocol.MessageType.PING:
+            if device.last_ping_sent_at is not None:
+                self.latencies.add(
+                    "response", perf_counter() - device.last_ping_sent_at
+                )
+                device.last_ping_sent_at = None
+        elif data.payload.message_type_id in protocol.Payload.MESSAGE_TYPE_MAP:
+            self.respond(device, data)
+
+    def receive(self, timeout: float):
+        readable, _, _ = select.select(self._sockets, [], [], timeout)
+        for sock in readable:
+            for datagram, _ in self._receiver.drain(sock):
+                try:
+                    self.handle(codec.parse(datagram))
+                except Exception:
+                    log.exception("Device failed to process the data")
+
+    def run(self, duration: float, stop: threading.Event):
+        started_at = perf_counter()
+        # Devices boot up with a report of their firmware version, then ping every `ping_interval` seconds
+        schedule = [
+            (started_at + self._random.uniform(0, self.ping_interval), device_id)
+            for device_id in self.devices.keys()
+        ]
+        heapq.heapify(schedule)
+        for device in self.devices.values():
+            self.send_code_version(device)
+
+        while not stop.is_set():
+            now = perf_counter()
+            if now - started_at >= duration:
+                break
+
+            while schedule and schedule[0][0] <= now:
+                _, device_id = heapq.heappushpop(
+                    schedule, (schedule[0][0] + self.ping_interval, schedule[0][1])
+                )
+                self.send_ping(self.devices[device_id])
+
+            self.receive(max(0, min(0.05, schedule[0][0] - now)) if schedule else 0.05)
+
+
+class FakeCloud:
+    # Local stand-in for www.cloudwarm.net: confirms pings and firmware reports, ignores the rest
+
+    def __init__(
+        self,
+        address: typing.Tuple[str, int],
+        fleet: VirtualFleet,
+        latencies: Latencies,
+    ):
+        self.fleet = fleet
+        self.latencies = latencies
+        self.received = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        self._socket.setblocking(False)
+        self._socket.bind(address)
+        self._receiver = BatchReceiver()
+
+    def close(self):
+        self._socket.close()
+
+    def handle(self, data: protocol.Timeguard, address: typing.Tuple[str, int]):
+        payload = data.payload
+        sent_at = self.fleet.sent_at.get((payload.device_id, data.message_id))
+        if sent_at is not None:
+            self.latencies.add("relay", perf_counter() - sent_at)
+
+        if payload.message_type == protocol.MessageType.PING:
+            response = protocol.Timeguard.prepare(
+                protocol.MessageType.PING,
+                protocol.MessageFlags.server(True) | protocol.MessageFlags.IS_SUCCESS,
+                payload.device_id,
+                payload_seq=0xFF,
+                now=Arrow.now(),
+            )
+        elif (
+            payload.message_type == protocol.MessageType.CODE_VERSION
+            and payload.message_flags & protocol.MessageFlags.IS_UPDATE_REQUEST
+        ):
+            response = protocol.Timeguard.prepare(
+                protocol.MessageType.CODE_VERSION,
+                protocol.MessageFlags.server(True, False)
+                | protocol.MessageFlags.IS_SUCCESS,
+                payload.device_id,
+                payload_seq=0xFF,
+                code_version=payload.params.code_version,
+            )
+        else:
+            return
+
+        self._socket.sendto(codec.build(response), address)
+
+    def run(self, stop: threading.Event):
+        while not stop.is_set():
+            readable, _, _ = select.select([self._socket], [], [], 0.1)
+            if not readable:
+                continue
+
+            for datagram, address in self._receiver.drain(self._socket):
+                self.received += 1
+                try:
+                    self.handle(codec.parse(datagram), address)
+                except Exception:
+                    log.exception("Cloud failed to process the data")
+
+
+def run_mqtt(
+    mqtt: Mqtt,
+    network_events_queue: Queue,
+    fleet: VirtualFleet,
+    latencies: Latencies,
+    stop: threading.Event,
+):
+    # Mqtt.run without the broker: the time is measured from the moment a device has sent the data till its state
+    # is handed over to the MQTT client. Publishes held back by --publish-window are sent, but not measured.
+    while not stop.is_set():
+        mqtt.publisher.flush()
+        try:
+            data: protocol.Timeguard = network_events_queue.get(timeout=0.1)
+        except QueueEmptyError:
+            continue
+
+        published = mqtt.client.published
+        try:
+            mqtt.handle_protocol_data(data)
+        except Exception:
+            log.exception("Failed to process network message")
+            continue
+
+        if mqtt.client.published == published:
+            continue
+
+        sent_at = fleet.sent_at.get((data.payload.device_id, data.message_id))
+        if sent_at is not None:
+            latencies.add("mqtt_publish", perf_counter() - sent_at)
+
+
+def prepare_argparse(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--devices",
+        help="Number of virtual devices.",
+        default=1000,
+        type=int,
+    )
+    parser.add_argument(
+        "--duration",
+        help="Seconds to run the simulation for.",
+        default=30,
+        type=float,
+    )
+    parser.add_argument(
+        "--ping-interval",
+        help="Seconds between the pings of every device.",
+        default=10,
+        type=float,
+    )
+    parser.add_argument(
+        "--devices-per-socket",
+        help="Number of virtual devices sharing a single UDP socket.",
+        default=64,
+        type=int,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed for the randomness of the simulation.",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="Write JSON results to the file.",
+    )
+
+
+def run(argv: typing.Optional[typing.List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="timeguard-mqtt simulate",
+        description="Load test with a fleet of virtual devices and a local stand-in for the cloud",
+    )
+    parser.add_argument("--debug", "-d", action="store_true")
+    prepare_argparse(parser.add_argument_group("Simulation"))
+    ProtocolHandler.prepare_argparse(parser.add_argument_group("Protocol"))
+    Mqtt.prepare_argparse(parser.add_argument_group("MQTT"))
+    queues.prepare_argparse(parser.add_argument_group("Queues"))
+    parser.set_defaults(
+        listen_address="127.0.0.1",
+        listen_port=19997,
+        cloud_address="127.0.0.2",
+        cloud_port=19997,
+    )
+    args = parser.parse_args(argv)
+
+    lh = logging.StreamHandler(sys.stderr)
+    lh.setFormatter(logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s"))
+    log.addHandler(lh)
+    log.setLevel(logging.DEBUG if args.debug else logging.WARNING)
+
+    latencies = Latencies()
+    network_events_queue = queues.NetworkEventsQueue(args.network_queue_size)
+    mqtt_events_queue = queues.CommandsQueue(maxsize=args.commands_queue_size)
+
+    handler = ProtocolHandler(args, network_events_queue, mqtt_events_queue)
+    mqtt = Mqtt(args, network_events_queue, mqtt_events_queue)
+    mqtt.client = StubMqttClient()
+    fleet = VirtualFleet(
+        args.devices,
+        (args.listen_address, args.listen_port),
+        latencies,
+        args.ping_interval,
+        args.devices_per_socket,
+        args.seed,
+    )
+    cloud = FakeCloud((args.cloud_address, args.cloud_port), fleet, latencies)
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=handler.run, daemon=True),
+        threading.Thread(target=cloud.run, args=(stop,), daemon=True),
+        threading.Thread(
+            target=run_mqtt,
+            args=(mqtt, network_events_queue, fleet, latencies, stop),
+            daemon=True,
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+
+    # Give the handler a moment to bind the socket
+    sleep(0.2)
+    try:
+        fleet.run(args.duration, stop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        handler.stop()
+        for thread in threads:
+            thread.join()
+        fleet.close()
+        cloud.close()
+
+    report = {
+        "devices": args.devices,
+        "duration": args.duration,
+        "ping_interval": args.ping_interval,
+        "mode": args.mode,
+        "engine": args.engine,
+        "sent_by_devices": fleet.sent,
+        "received_by_devices": fleet.received,
+        "received_by_cloud": cloud.received,
+        "mqtt_publishes": mqtt.client.published,
+        "latency": latencies.summary(),
+        "queues": {
+            "network_events": {
+                "high_water": network_events_queue.high_water,
+                "overflows": network_events_queue.overflows,
+                "coalesced": network_events_queue.coalesced,
+            },
+            "mqtt_events": {
+                "high_water": mqtt_events_queue.high_water,
+                "overflows": mqtt_events_queue.overflows,
+            },
+        },
+    }
+
+    for name, summary in report["latency"].items():
+        print(
+            "{:<14} count={:<8} p50={:>9.3f} ms  p99={:>9.3f} ms  max={:>9.3f} ms".format(
+                name,
+                summary["count"],
+                summary["p50"] * 1000,
+                summary["p99"] * 1000,
+                summary["max"] * 1000,
+            )
+        )
+    print(
+        "devices sent {sent_by_devices} and received {received_by_devices} messages, cloud received "
+        "{received_by_cloud}, {mqtt_publishes} MQTT publishes".format(**report)
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,158 @@
+import argparse
+import json
+import sqlite3
+import threading
+import typing
+
+from timeguard_mqtt import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS addresses (
+    device_id INTEGER PRIMARY KEY,
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    device_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (device_id, name)
+);
+CREATE TABLE IF NOT EXISTS schedules (
+    device_id INTEGER NOT NULL,
+    schedule_id INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (device_id, schedule_id)
+);
+"""
+
+UPSERTS = {
+    "addresses": "INSERT OR REPLACE INTO addresses VALUES (?, ?, ?)",
+    "parameters": "INSERT OR REPLACE INTO parameters VALUES (?, ?, ?)",
+    "schedules": "INSERT OR REPLACE INTO schedules VALUES (?, ?, ?)",
+}
+
+
+class DeviceStore:
+    # What is known about the devices, kept in SQLite between restarts. The addresses are read once, at the start, and
+    # kept in memory; the rest of a device is read the first time it's asked for, together with its writes not
+    # committed yet. The writes are collected in memory (the latest value wins) and committed in batches by a
+    # background thread every `flush_interval` seconds.
+
+    def __init__(self, path: str, flush_interval: float = 1):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db_lock = threading.Lock()
+        # Asked for on the receive path, which mustn't wait for the disk
+        self._addresses: typing.Dict[int, typing.Tuple[str, int]] = {
+            device_id: (ip, port)
+            for device_id, ip, port in self._db.execute(
+                "SELECT device_id, ip, port FROM addresses"
+            )
+        }
+        # device_id -> (table, key) -> row
+        self._pending: typing.Dict[int, typing.Dict[tuple, tuple]] = {}
+        self._pending_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="device-store", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        # The database stays locked until the writes are committed, so the readers find them in one place or the other
+        with self._db_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+
+            if not pending:
+                return
+
+            rows = {table: [] for table in UPSERTS}
+            for device_pending in pending.values():
+                for (table, _), row in device_pending.items():
+                    rows[table].append(row)
+
+            try:
+                with self._db:
+                    for table, table_rows in rows.items():
+                        if table_rows:
+                            self._db.executemany(UPSERTS[table], table_rows)
+            except:
+                log.exception("Failed to save the devices state to %s", self.path)
+
+    def _put(self, table: str, device_id: int, key, row: tuple):
+        with self._pending_lock:
+            self._pending.setdefault(device_id, {})[(table, key)] = row
+
+    def _get_pending(self, device_id: int) -> typing.Dict[tuple, tuple]:
+        with self._pending_lock:
+            return dict(self._pending.get(device_id, {}))
+
+    def save_address(self, device_id: int, address: typing.Tuple[str, int]):
+        self._addresses[device_id] = tuple(address)
+        self._put("addresses", device_id, None, (device_id,) + tuple(address))
+
+    def save_parameter(self, device_id: int, name: str, value):
+        self._put("parameters", device_id, name, (device_id, name, json.dumps(value)))
+
+    def save_schedule(self, device_id: int, schedule_id: int, data: bytes):
+        self._put("schedules", device_id, schedule_id, (device_id, schedule_id, data))
+
+    def get_address(self, device_id: int) -> typing.Optional[typing.Tuple[str, int]]:
+        return self._addresses.get(device_id)
+
+    def load(self, device_id: int) -> typing.Tuple[dict, typing.Dict[int, bytes]]:
+        # Parameters and raw schedules of the device, empty when it has never been seen
+        with self._db_lock:
+            parameters = dict(
+                self._db.execute(
+                    "SELECT name, value FROM parameters WHERE device_id = ?",
+                    (device_id,),
+                )
+            )
+            schedules = dict(
+                self._db.execute(
+                    "SELECT schedule_id, data FROM schedules WHERE device_id = ?",
+                    (device_id,),
+                )
+            )
+            for (table, key), row in self._get_pending(device_id).items():
+                if table == "parameters":
+                    parameters[key] = row[2]
+                elif table == "schedules":
+                    schedules[key] = row[2]
+
+        return {
+            name: json.loads(value) for name, value in parameters.items()
+        }, schedules
+
+
+def prepare_argparse(parser: argparse._ActionsContainer):
+    parser.add_argument(
+        "--state-file",
+        help="Keep the devices' addresses, code versions and schedules in the SQLite database between the restarts.",
+    )
+    parser.add_argument(
+        "--state-flush-interval",
+        help="How often the changes are written to the state file, in seconds.",
+        default=1,
+        type=float,
+    )
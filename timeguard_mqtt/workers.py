@@ -0,0 +1,209 @@
+import multiprocessing
+from queue import Empty as QueueEmptyError, Queue
+import signal
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from timeguard_mqtt import log, protocol
+from timeguard_mqtt.protocol_handler import ProtocolHandler
+from timeguard_mqtt.registry import DeviceRegistry
+
+
+class SharedDeviceRegistry:
+    # `device_to_ip_map` shared between the worker processes. Every device is owned by the worker which receives its
+    # packets (the kernel spreads SO_REUSEPORT traffic by the source address), so commands for the device are routed
+    # to that worker — it's the one to receive the confirmations. The shared map is the only source of the addresses,
+    # every worker keeps a copy of what it has read from it until `version` changes: it's bumped after every write,
+    # so the copies don't need to be checked with the manager on every packet. The shared map is only written to
+    # when the address or the owner changes, and the worker removes its devices from it once they're evicted locally.
+
+    def __init__(
+        self,
+        shared: dict,
+        version,
+        worker_id: int,
+        ttl: float = 0,
+        max_size: int = 0,
+    ):
+        self._shared = shared
+        self._version = version
+        # Devices owned by this worker, only for their expiry
+        self._local = DeviceRegistry(ttl, max_size, on_evict=self._forget)
+        # (ip, port, owner) by the device, as read from the shared map at `_cache_version`
+        self._cache: Dict[int, Tuple[str, int, int]] = {}
+        self._cache_version = -1
+        self.worker_id = worker_id
+
+    def _lookup(self, device_id: int) -> Optional[Tuple[str, int, int]]:
+        version = self._version.value
+        if version != self._cache_version:
+            self._cache = {}
+            self._cache_version = version
+
+        value = self._cache.get(device_id)
+        if value is None:
+            value = self._shared.get(device_id)
+            if value is None:
+                return None
+
+            self._cache[device_id] = value
+
+        if value[2] != self.worker_id and device_id in self._local:
+            # Another worker has taken the device over, its NAT must have changed the address
+            self._local.pop(device_id)
+
+        return value
+
+    def _bump_version(self):
+        with self._version.get_lock():
+            self._version.value += 1
+            version = self._version.value
+
+        if version == self._cache_version + 1:
+            # Nothing else has changed since the copy was taken
+            self._cache_version = version
+        else:
+            self._cache = {}
+            self._cache_version = version
+
+    def __contains__(self, device_id: int) -> bool:
+        return self._lookup(int(device_id)) is not None
+
+    def __setitem__(self, device_id: int, address: Tuple[str, int]):
+        device_id = int(device_id)
+        value = address + (self.worker_id,)
+        if self._lookup(device_id) != value:
+            self._shared[device_id] = value
+            self._bump_version()
+            self._cache[device_id] = value
+
+        self._local[device_id] = address
+
+    def _forget(self, device_id: int, address: Tuple[str, int]):
+        self._cache.pop(device_id, None)
+        try:
+            if self._shared.get(device_id) == address + (self.worker_id,):
+                del self._shared[device_id]
+                self._bump_version()
+        except Exception:
+            # Another worker has just taken the device over, or the manager is shutting down
+            pass
+
+    def get(self, device_id: int, default=None) -> Optional[Tuple[str, int]]:
+        value = self._lookup(int(device_id))
+        if value is None:
+            return default
+
+        return value[:2]
+
+
+def run_worker(
+    args,
+    worker_id: int,
+    network_events_queue: multiprocessing.Queue,
+    commands_queue: multiprocessing.Queue,
+    registry: dict,
+    registry_version,
+    stop_event,
+):
+    # The parent process takes care of the termination
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    handler = ProtocolHandler(
+        args,
+        network_events_queue,
+        commands_queue,
+        SharedDeviceRegistry(
+            registry,
+            registry_version,
+            worker_id,
+            args.device_online_timeout,
+            args.max_devices,
+        ),
+    )
+
+    def wait_for_stop():
+        stop_event.wait()
+        handler.stop()
+
+    threading.Thread(target=wait_for_stop, daemon=True).start()
+    handler.run()
+
+
+class WorkerPool:
+    def __init__(
+        self,
+        args,
+        network_events_queue: multiprocessing.Queue,
+        mqtt_events_queue: Queue,
+    ):
+        self.args = args
+        self.network_events_queue = network_events_queue
+        self.mqtt_events_queue = mqtt_events_queue
+        self._context = multiprocessing.get_context("fork")
+        self._manager = None
+        self._processes: List[multiprocessing.Process] = []
+        self._commands_queues: List[multiprocessing.Queue] = []
+        self._stop_event = self._context.Event()
+        self._stop = False
+        self.registry = None
+        self.registry_version = None
+
+    def start_workers(self):
+        # Has to be called before any other thread is started, as the workers are forked
+        self._manager = self._context.Manager()
+        self.registry = self._manager.dict()
+        self.registry_version = self._context.Value("Q", 0)
+
+        for worker_id in range(self.args.workers):
+            commands_queue = self._context.Queue()
+            process = self._context.Process(
+                target=run_worker,
+                args=(
+                    self.args,
+                    worker_id,
+                    self.network_events_queue,
+                    commands_queue,
+                    self.registry,
+                    self.registry_version,
+                    self._stop_event,
+                ),
+                name="timeguard-worker-{}".format(worker_id),
+                daemon=True,
+            )
+            process.start()
+            self._commands_queues.append(commands_queue)
+            self._processes.append(process)
+
+        log.info("Started %d protocol workers", len(self._processes))
+
+    def run(self):
+        self._stop = False
+
+        while not self._stop:
+            try:
+                tg_data: protocol.Timeguard = self.mqtt_events_queue.get(timeout=0.5)
+            except QueueEmptyError:
+                continue
+
+            try:
+                self.dispatch(tg_data)
+            except Exception:
+                log.exception("Error while processing a message from MQTT")
+
+        self._stop_event.set()
+        for process in self._processes:
+            process.join()
+        self._manager.shutdown()
+
+    def dispatch(self, data: protocol.Timeguard):
+        owner = self.registry.get(int(data.payload.device_id))
+        if owner is None:
+            # The device hasn't been seen yet, there's nowhere to send the command to
+            return
+
+        self._commands_queues[owner[2]].put(data)
+
+    def stop(self):
+        self._stop = True